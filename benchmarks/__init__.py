@@ -0,0 +1 @@
+"""Performance benchmarks for ukebook_md, see benchmarks.run."""
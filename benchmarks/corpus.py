@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Generate a synthetic corpus of ukedown songsheets, for benchmarking.
+
+Songs are random but repeatable (for a given seed), and use the features
+found in real songsheets: metadata blocks, inline chords (mostly with
+definitions, a few without), section headers, boxed lines, backing vocals,
+performance notes and singer markers, with a good deal of lyrics.
+"""
+
+import argparse
+import random
+import re
+import sys
+from pathlib import Path
+
+import yaml
+
+CHORDLIST = Path(__file__).parent.parent / "ukebook_md" / "chords.yml"
+
+# the chord names ukedown will recognise, see ukedown.patterns.CHORD
+CHORD_NAME = re.compile(r"[A-G][adgijmnsu0-9#b+\-/*A-G]*")
+
+# chords with no definition in chords.yml, so missing chords are exercised
+UNDEFINED = ["C#maj9", "Gb13", "Ebm11"]
+
+# vocabulary for titles and lyrics
+VOCABULARY = """
+    love heart night day time home road rain sun moon sky river town light
+    dream fire song dance baby little long old new gone back down away
+    again never always still only just like know feel see say go come
+    walk run hold take give tell call find lose want need wait stay leave
+    morning evening summer winter yesterday tomorrow forever tonight
+    yeah oh hey the a my your our their in on under over through with
+    without and but when where why how all every nothing something
+"""
+WORDS = VOCABULARY.split()
+
+SECTIONS = ["Verse", "Chorus", "Bridge", "Intro", "Outro", "Instrumental"]
+
+
+def chord_names(chordlist: Path = CHORDLIST) -> list[str]:
+    """Return the names of defined chords that ukedown can recognise."""
+    definitions = yaml.safe_load(chordlist.read_text())
+    return [c for c in definitions if CHORD_NAME.fullmatch(c)]
+
+
+def lyric_line(rng: random.Random, chords: list[str]) -> str:
+    """Generate a line of lyrics with inline chords."""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 12))]
+    line = []
+    for i, word in enumerate(words):
+        if i == 0 or rng.random() < 0.35:
+            line.append(f"({rng.choice(chords)}){word}")
+        else:
+            line.append(word)
+    if rng.random() < 0.15:
+        line.append(f"({' '.join(rng.choice(WORDS) for _ in range(2))})")
+    return " ".join(line)
+
+
+def songsheet(rng: random.Random, number: int, chords: list[str], verses: int) -> str:
+    """Generate the content of a songsheet.
+
+    Args:
+        rng(random.Random): source of randomness
+        number(int): song number, used in the title
+        chords(list): chord names to choose from
+        verses(int): approximate number of sections
+    """
+    # a handful of chords per song, as in real life
+    used = rng.sample(chords, k=min(len(chords), rng.randint(3, 10)))
+    if rng.random() < 0.05:
+        used.append(rng.choice(UNDEFINED))
+
+    title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+    artist = " ".join(rng.choice(WORDS) for _ in range(2)).title()
+
+    lines = []
+    if rng.random() < 0.6:
+        lines.append(f"; tags: [{rng.choice(WORDS)}, {rng.choice(WORDS)}]")
+        lines.append(f"; capo: {rng.randint(0, 5)}")
+    if rng.random() < 0.2:
+        lines.append(f"; font_size: {rng.choice(['0.9em', '1.1em', '1.2em'])}")
+    if rng.random() < 0.1:
+        lines.append(f"; landscape_font_size: {rng.choice(['0.8em', '1em'])}")
+    lines.append(f"{title} {number} - {artist}")
+    lines.append("")
+
+    for section in range(rng.randint(max(1, verses - 2), verses + 2)):
+        name = rng.choice(SECTIONS)
+        lines.append(f"[{name} {section + 1}]")
+        if rng.random() < 0.2:
+            lines.append(f"{{ {' '.join(rng.choice(WORDS) for _ in range(3))} }}")
+        for _ in range(rng.randint(3, 8)):
+            line = lyric_line(rng, used)
+            if rng.random() < 0.1:
+                line = f"| {line} x2 |"
+            if rng.random() < 0.05:
+                line = f"{line} <singer {rng.randint(1, 3)}>"
+            lines.append(line)
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def generate_corpus(
+    destdir: Path, count: int = 100, seed: int = 0, verses: int = 6
+) -> list[Path]:
+    """Write a corpus of synthetic songsheets.
+
+    Args:
+        destdir(Path): directory to create songsheets in
+        count(int): number of songsheets
+        seed(int): random seed, the same seed gives the same corpus
+        verses(int): approximate number of sections per song
+
+    Returns:
+        list: paths to generated songsheets
+    """
+    rng = random.Random(seed)
+    chords = chord_names()
+    destdir.mkdir(parents=True, exist_ok=True)
+    songs = []
+    for n in range(count):
+        song = destdir / f"song_{n:05d}.udn"
+        song.write_text(songsheet(rng, n, chords, verses))
+        songs.append(song)
+    return songs
+
+
+def main():
+    """Generate a corpus from the commandline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("destdir", type=Path, help="where to write songsheets")
+    parser.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=100,
+        help="number of songsheets (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--verses",
+        type=int,
+        default=6,
+        help="approximate number of sections per song (default: %(default)s)",
+    )
+    opts = parser.parse_args(sys.argv[1:])
+    songs = generate_corpus(opts.destdir, opts.count, opts.seed, opts.verses)
+    print(f"{len(songs)} songsheets written to {opts.destdir}")
+
+
+if __name__ == "__main__":
+    main()
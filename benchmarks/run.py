@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Run performance benchmarks against a synthetic songsheet corpus.
+
+Run from the top of the repository:
+
+    python -m benchmarks.run --songs 1000
+    python -m benchmarks.run --compare benchmarks/results/OLD.json
+
+Results are saved as JSON in benchmarks/results, named for the current
+commit, so that runs on the same machine can be compared between commits.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+
+import yaml
+
+from benchmarks.corpus import generate_corpus
+
+TOPDIR = Path(__file__).parent.parent
+PACKAGE = TOPDIR / "ukebook_md"
+RESULTS = Path(__file__).parent / "results"
+
+RESULTS_VERSION = 1
+
+# commandline options for each book format benchmarked with genbook.main
+FORMATS = {
+    "web": [],
+    "karauke": ["-k"],
+    "singers": ["-S"],
+    "external": ["--external"],
+    "sprite": ["--sprite"],
+    "onepage": ["-p"],
+    "epub": ["-e"],
+}
+
+# how many songs to use for the parse_song and makepdf.collate benchmarks
+SAMPLE_SIZE = 20
+
+
+def parse_cmdline(argv: list[str]) -> argparse.Namespace:
+    """Process commandline options and arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark songbook generation on a synthetic corpus"
+    )
+    parser.add_argument(
+        "-n",
+        "--songs",
+        type=int,
+        default=100,
+        help="number of songsheets in the corpus (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of times to run each benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        help="only run benchmarks whose names start with this (repeatable)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help="where to save results (default: benchmarks/results/COMMIT.json)",
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        type=Path,
+        help="previous results to compare against",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="corpus random seed (default: %(default)s)"
+    )
+    return parser.parse_args(argv)
+
+
+def git_revision() -> str:
+    """Return the current commit, marked if the tree has local changes."""
+    try:
+        rev = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=TOPDIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = "unknown"
+    return rev
+
+
+def measure(func: Callable, repeat: int) -> dict:
+    """Run a function several times, timing it.
+
+    Output is discarded, so progress bars and messages do not interfere.
+
+    Returns:
+        dict: minimum, median and mean wall-clock times in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        with (
+            contextlib.redirect_stdout(io.StringIO()),
+            contextlib.redirect_stderr(io.StringIO()),
+        ):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "repeat": repeat,
+    }
+
+
+def htmlbook(corpus: Path, output: Path, *args: str):
+    """Run a complete genbook build, in a separate process.
+
+    Runs from the package directory, as genbook writes chord diagrams for
+    inline SVG relative to the current directory.
+    """
+    subprocess.run(
+        [sys.executable, "-m", "ukebook_md.genbook", str(corpus), "-o", str(output)]
+        + list(args),
+        cwd=PACKAGE,
+        env={**os.environ, "PYTHONPATH": str(TOPDIR)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def benchmarks(corpus: Path, workdir: Path) -> dict[str, Callable]:
+    """Define the benchmarks to run.
+
+    Args:
+        corpus(Path): directory of songsheets
+        workdir(Path): scratch space for output
+    """
+    from ukebook_md import chordgen, genbook
+
+    songs = sorted(corpus.glob("*.udn"))
+    sample = songs[:SAMPLE_SIZE]
+    chorddefs = yaml.safe_load((PACKAGE / "chords.yml").read_text())
+    cache = genbook.SongCache(workdir / "cache")
+
+    def parse_sample(**kwargs):
+        for song in sample:
+            genbook.parse_song(song, **kwargs)
+
+    tests: dict[str, Callable] = {
+        "parse_song": parse_sample,
+        "parse_song[cached]": lambda: parse_sample(cache=cache),
+        "parse_songsheets": lambda: genbook.parse_songsheets([corpus], None),
+        "parse_songsheets[cached]": lambda: genbook.parse_songsheets(
+            [corpus], None, cache=cache
+        ),
+        "parse_songsheets[jobs]": lambda: genbook.parse_songsheets(
+            [corpus], None, jobs=os.cpu_count() or 1
+        ),
+        "chordgen.generate": lambda: chordgen.generate(
+            list(chorddefs),
+            chorddefs,
+            destdir=workdir / "chords",
+            template="chord_ext.svg.j2",
+        ),
+    }
+
+    for name, args in FORMATS.items():
+        tests[f"genbook.main[{name}]"] = lambda name=name, args=args: htmlbook(
+            corpus, workdir / name, "--no-cache", "--clean", *args
+        )
+    tests["genbook.main[incremental]"] = lambda: htmlbook(
+        corpus, workdir / "web", "--cache-dir", str(workdir / "cache")
+    )
+
+    try:
+        from ukebook_md import makepdf
+    except (ImportError, OSError) as E:
+        print(f"Skipping makepdf.collate, WeasyPrint is not available: {E}")
+    else:
+        book = workdir / "pdfbook"
+        smallbook = workdir / "smallbook"
+        smallbook.mkdir()
+        for song in sample:
+            (smallbook / song.name).symlink_to(song)
+        htmlbook(smallbook, book, "--no-cache", "--external")
+        opts = argparse.Namespace(
+            inputdir=book,
+            output=workdir / "pdfbook.pdf",
+            stylesheets=[Path("portrait")],
+            jobs=1,
+            volume_size=None,
+            cache=False,
+            no_cache=True,
+            cache_dir=workdir / "cache",
+            cache_size=1024,
+        )
+        variants = {
+            "makepdf.collate": opts,
+            "makepdf.collate[jobs]": argparse.Namespace(**{
+                **vars(opts),
+                "jobs": os.cpu_count() or 1,
+            }),
+            "makepdf.collate[cached]": argparse.Namespace(**{
+                **vars(opts),
+                "cache": True,
+                "no_cache": False,
+            }),
+        }
+        for name, variant in variants.items():
+            tests[name] = lambda variant=variant: makepdf.collate(
+                variant, makepdf.FontConfiguration()
+            )
+
+    return tests
+
+
+def compare(previous: dict, current: dict):
+    """Print a comparison of two sets of results."""
+    print(f"\n{'benchmark':32} {previous['revision']:>12} {current['revision']:>12}")
+    for name, result in current["results"].items():
+        old = previous["results"].get(name)
+        if old is None:
+            print(f"{name:32} {'-':>12} {result['median']:>11.3f}s")
+            continue
+        change = (result["median"] - old["median"]) / old["median"] * 100
+        print(
+            f"{name:32} {old['median']:>11.3f}s {result['median']:>11.3f}s "
+            f"{change:+6.1f}%"
+        )
+
+
+def main():
+    """Run all the benchmarks."""
+    opts = parse_cmdline(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory(prefix="ukebook-bench-") as td:
+        workdir = Path(td)
+        corpus = workdir / "corpus"
+        print(f"Generating {opts.songs} songsheets")
+        generate_corpus(corpus, opts.songs, seed=opts.seed)
+
+        results = {}
+        for name, func in benchmarks(corpus, workdir).items():
+            if opts.benchmark and not any(name.startswith(b) for b in opts.benchmark):
+                continue
+            results[name] = measure(func, opts.repeat)
+            print(f"{name:32} {results[name]['median']:>11.3f}s")
+
+    report = {
+        "version": RESULTS_VERSION,
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "songs": opts.songs,
+        "seed": opts.seed,
+        "results": results,
+    }
+
+    output = opts.output or RESULTS / f"{report['revision']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Results written to {output}")
+
+    if opts.compare:
+        compare(json.loads(opts.compare.read_text()), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Golden output regression checks for ukebook_md, see regression.check."""
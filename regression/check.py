@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Compare generated songbooks against stored golden output.
+
+Builds a book from the fixture corpus for each variant (format, layout and
+orientation), in each build mode (sequential, parallel, cached, streaming,
+incremental, and without the cache after a cached build). Every generated
+HTML/SVG file must be byte-identical to the golden copy, which was made with
+a plain sequential build. Incremental builds add a song to the book, and must
+only render it and the songs either side again.
+
+PDFs made from the portrait and landscape books are compared structurally
+(pages, sizes, text, links and destinations), as their bytes are not
+reproducible. This needs WeasyPrint and pypdf, and is skipped without them,
+but fails if there is no golden PDF structure for a variant.
+Each is made in a single process, with worker processes (makepdf -j) and
+from the cache. Links between separately rendered parts must still work when
+they are merged, which is checked with small generated PDFs (needs pypdf).
+
+Run from the top of the repository:
+
+    python -m regression.check
+    python -m regression.check --update   # after an intended output change
+"""
+
+import argparse
+import difflib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import yaml
+
+from ukebook_md.wordfilter import default_filter
+
+TOPDIR = Path(__file__).parent.parent
+PACKAGE = TOPDIR / "ukebook_md"
+FIXTURES = Path(__file__).parent / "fixtures"
+GOLDEN = Path(__file__).parent / "golden"
+
+# genbook options for each variant of the book
+VARIANTS = {
+    "web": [],
+    "karauke": ["-k"],
+    "singers": ["-S"],
+    "family": ["-F"],
+    "onepage": ["-p"],
+    "epub": ["-e"],
+    "sprite": ["--sprite"],
+    "portrait": ["--external", "-s", "portrait"],
+    "landscape": ["--external", "-l", "-s", "landscape"],
+}
+
+# variants that are also converted to PDF, and the stylesheet to use
+PDF_VARIANTS = {
+    "portrait": "portrait",
+    "landscape": "landscape",
+}
+
+# build modes that must produce the same output as a sequential build.
+# Each is a list of builds into the same output directory, the last is checked
+MODES = {
+    "sequential": [["--no-cache"]],
+    "parallel": [["--no-cache", "-j", "2"]],
+    "cached": [["--cache-dir", "{cache}"], ["--cache-dir", "{cache}", "--clean"]],
+    "streaming": [["--cache-dir", "{cache}", "--stream"]],
+    # the first build is without INSERTED, which is added for the second.
+    # Nothing changes for the third
+    "incremental": [["--no-cache"], ["--no-cache"], ["--no-cache"]],
+    # a book's chord diagrams are linked to the shared store, rebuilding it
+    # without the cache (and other definitions) must not change the store
+    "uncached-rebuild": [
+        ["--cache-dir", "{cache}"],
+        ["--no-cache", "--chordlist", "{chords}"],
+        ["--cache-dir", "{cache}"],
+    ],
+}
+
+# song added to the book by the incremental mode, and the songs either side,
+# which must be the only pages rendered again
+INSERTED = "hello_world"
+NEIGHBOURS = {"hello world", "instrumental"}
+
+# makepdf options for each PDF build mode, as for MODES
+PDF_MODES = {
+    "sequential": [["--no-cache"]],
+    "parallel": [["--no-cache", "-j", "2"]],
+    "cached": [
+        ["--cache", "--cache-dir", "{cache}"],
+        ["--cache", "--cache-dir", "{cache}"],
+    ],
+}
+
+# static assets copied into books, these are not compared
+ASSET_DIRS = ("css", "images", "scripts")
+
+# family-friendly (-F) replacements, checked directly rather than against
+# golden output, so a change in behaviour cannot be blessed with --update
+WORDFILTER_CASES = {
+    "(F)shit, I": "(F)shoot, I",
+    "Shit SHIT": "Shoot SHOOT",
+    "(C)shitting": "(C)shootting",
+    "bullshit": "bullshoot",
+    "motherfucker": "motherforgeter",
+    "fuckers": "forgeters",
+    "fucked": "forgot",
+    "Shitake mushrooms": "Shitake mushrooms",
+}
+
+
+def parse_cmdline(argv: list[str]) -> argparse.Namespace:
+    """Process commandline options and arguments."""
+    parser = argparse.ArgumentParser(
+        description="Compare generated songbooks against golden output"
+    )
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        default=False,
+        help="regenerate the golden output from a sequential build",
+    )
+    parser.add_argument(
+        "-v",
+        "--variant",
+        action="append",
+        choices=VARIANTS,
+        help="only check these variants (repeatable)",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="append",
+        choices=MODES,
+        help="only check these build modes (repeatable)",
+    )
+    parser.add_argument(
+        "--no-pdf",
+        action="store_true",
+        default=False,
+        help="do not build or compare PDFs",
+    )
+    return parser.parse_args(argv)
+
+
+def run(module: str, *args: str):
+    """Run one of the ukebook_md tools, in a separate process.
+
+    Runs from the package directory, as genbook writes chord diagrams for
+    inline SVG relative to the current directory.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-m", f"ukebook_md.{module}", *args],
+        cwd=PACKAGE,
+        env={**os.environ, "PYTHONPATH": str(TOPDIR)},
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        print(proc.stdout, proc.stderr, sep="\n")
+        raise RuntimeError(f"{module} {' '.join(args)} failed")
+
+
+def altered_chordlist(workdir: Path) -> Path:
+    """Write chord definitions which draw every diagram differently.
+
+    Returns:
+        Path: chord definitions file (YAML)
+    """
+    chordlist = workdir / "altered-chords.yml"
+    if not chordlist.exists():
+        definitions = yaml.safe_load((PACKAGE / "chords.yml").read_text())
+        for definition in definitions.values():
+            definition["name"] = "altered"
+        chordlist.write_text(yaml.safe_dump(definitions))
+    return chordlist
+
+
+def genbook_args(variant: str, mode: str, workdir: Path) -> list[list[str]]:
+    """Return the genbook options for each build in a mode."""
+    return [
+        [
+            a.format(
+                cache=workdir / f"cache-{variant}-{mode}",
+                chords=altered_chordlist(workdir),
+            )
+            for a in extra
+        ]
+        for extra in MODES[mode]
+    ]
+
+
+def build(variant: str, mode: str, workdir: Path) -> Path:
+    """Build the fixture book for a variant in the given mode.
+
+    Returns:
+        Path: top-level directory of the generated book
+    """
+    output = workdir / f"{variant}-{mode}"
+    for args in genbook_args(variant, mode, workdir):
+        run("genbook", str(FIXTURES), "-o", str(output), *VARIANTS[variant], *args)
+    return output
+
+
+def song_pages(book: Path) -> dict[str, tuple[int, int]]:
+    """Identify the file holding each song page, which changes when rewritten.
+
+    Pages are replaced rather than written in place, so the inode number
+    changes even if the modification time does not.
+    """
+    return {
+        page.stem: (page.stat().st_ino, page.stat().st_mtime_ns)
+        for page in book.rglob("songs/*.html")
+    }
+
+
+def build_incremental(variant: str, workdir: Path) -> tuple[Path, list[str]]:
+    """Build a book, add a song and build it again, then rebuild it unchanged.
+
+    Only the new song's neighbours should be rendered again when it is added,
+    and nothing when there are no changes.
+
+    Returns:
+        Path: top-level directory of the generated book
+        list: description of any pages rendered when they should not have
+              been, or not rendered when they should
+    """
+    output = workdir / f"{variant}-incremental"
+    corpus = workdir / f"fixtures-{variant}"
+    shutil.copytree(FIXTURES, corpus, ignore=shutil.ignore_patterns(INSERTED + ".*"))
+
+    first, insert, rebuild = genbook_args(variant, "incremental", workdir)
+    run("genbook", str(corpus), "-o", str(output), *VARIANTS[variant], *first)
+    before = song_pages(output)
+
+    shutil.copy(FIXTURES / f"{INSERTED}.udn", corpus)
+    run("genbook", str(corpus), "-o", str(output), *VARIANTS[variant], *insert)
+    after = song_pages(output)
+
+    problems = []
+    if before and INSERTED not in after:
+        problems.append(f"inserted song {INSERTED} was not rendered")
+    for name, version in before.items():
+        if name in NEIGHBOURS and after.get(name) == version:
+            problems.append(f"neighbour {name} not rendered after inserting a song")
+        elif name not in NEIGHBOURS and after.get(name) != version:
+            problems.append(f"{name} rendered again after inserting a song")
+
+    run("genbook", str(corpus), "-o", str(output), *VARIANTS[variant], *rebuild)
+    problems.extend(
+        f"{name} rendered again with nothing changed"
+        for name, version in song_pages(output).items()
+        if after.get(name) != version
+    )
+    shutil.rmtree(corpus)
+    return output, problems
+
+
+def generated_files(book: Path) -> dict[str, bytes]:
+    """Return the content of every generated file in a book.
+
+    Build records and copies of static assets are left out.
+    """
+    files = {}
+    for path in sorted(book.rglob("*")):
+        if not path.is_file() or path.name in (".timestamp", ".manifest.json"):
+            continue
+        relpath = path.relative_to(book)
+        if (
+            len(relpath.parts) > 1
+            and relpath.parts[-2] in ASSET_DIRS
+            and (PACKAGE / relpath.parts[-2] / relpath.name).exists()
+        ):
+            continue
+        files[str(relpath)] = path.read_bytes()
+    return files
+
+
+def pdf_structure(pdffile: Path) -> dict:
+    """Describe the structure of a PDF, for comparison.
+
+    Covers everything a reader would notice: page count and sizes, the text
+    on each page, link annotations and named destinations.
+    """
+    import pypdf  # type: ignore
+
+    reader = pypdf.PdfReader(pdffile)
+    named = reader.named_destinations
+
+    def target(annot) -> str:
+        # internal links may use named or explicit destinations, which are
+        # equivalent, so resolve both to a page number
+        action = annot.get("/A") or {}
+        dest = annot.get("/Dest") or action.get("/D")
+        if dest is None:
+            return str(action.get("/URI"))
+        if isinstance(dest, str):
+            if dest not in named:
+                return f"missing {dest}"
+            return f"page {reader.get_destination_page_number(named[dest])}"
+        return f"page {reader.get_page_number(dest[0].get_object())}"
+
+    pages = []
+    for page in reader.pages:
+        links = [
+            target(annot.get_object())
+            for annot in page.get("/Annots") or []
+            if annot.get_object().get("/Subtype") == "/Link"
+        ]
+        pages.append({
+            "size": [round(float(x), 2) for x in page.mediabox],
+            "text": page.extract_text(),
+            "links": links,
+        })
+    destinations = {
+        name: reader.get_destination_page_number(dest)
+        for name, dest in reader.named_destinations.items()
+    }
+    return {"pages": pages, "destinations": dict(sorted(destinations.items()))}
+
+
+def build_pdf(book: Path, variant: str, mode: str, workdir: Path) -> dict:
+    """Convert a book to PDF, returning its structure."""
+    pdffile = workdir / f"{variant}-{mode}.pdf"
+    for extra in PDF_MODES[mode]:
+        args = [a.format(cache=workdir / f"pdfcache-{variant}-{mode}") for a in extra]
+        run(
+            "makepdf",
+            str(book),
+            "-o",
+            str(pdffile),
+            "-s",
+            PDF_VARIANTS[variant],
+            *args,
+        )
+    return pdf_structure(pdffile)
+
+
+def pdf_available() -> bool:
+    """Check whether PDFs can be generated and read here."""
+    try:
+        import pypdf  # type: ignore # noqa: F401
+        import weasyprint  # type: ignore # noqa: F401
+    except (ImportError, OSError) as E:
+        print(f"Skipping PDF comparisons: {str(E).splitlines()[0]}")
+        return False
+    return True
+
+
+def compare(expected: dict[str, bytes], actual: dict[str, bytes]) -> list[str]:
+    """Compare two sets of files, returning a description of any differences."""
+    problems = []
+    for name in sorted(expected.keys() - actual.keys()):
+        problems.append(f"missing: {name}")
+    for name in sorted(actual.keys() - expected.keys()):
+        problems.append(f"unexpected: {name}")
+    for name in sorted(expected.keys() & actual.keys()):
+        if expected[name] == actual[name]:
+            continue
+        diff = difflib.unified_diff(
+            expected[name].decode(errors="replace").splitlines(),
+            actual[name].decode(errors="replace").splitlines(),
+            f"golden/{name}",
+            name,
+            lineterm="",
+        )
+        problems.append(f"differs: {name}\n" + "\n".join(list(diff)[:20]))
+    return problems
+
+
+def load_golden(variant: str) -> dict[str, bytes]:
+    """Load the golden files for a variant."""
+    golden = GOLDEN / variant
+    return {
+        str(p.relative_to(golden)): p.read_bytes()
+        for p in sorted(golden.rglob("*"))
+        if p.is_file() and p != golden / "pdf.json"
+    }
+
+
+def update(variants: list[str], pdfs: bool, workdir: Path):
+    """Regenerate the golden output from sequential builds."""
+    for variant in variants:
+        book = build(variant, "sequential", workdir)
+        golden = GOLDEN / variant
+        shutil.rmtree(golden, ignore_errors=True)
+        for name, content in generated_files(book).items():
+            (golden / name).parent.mkdir(parents=True, exist_ok=True)
+            (golden / name).write_bytes(content)
+        if pdfs and variant in PDF_VARIANTS:
+            structure = build_pdf(book, variant, "sequential", workdir)
+            (golden / "pdf.json").write_text(json.dumps(structure, indent=1) + "\n")
+        print(f"updated {golden}")
+
+
+def check_pdf(book: Path, variant: str, workdir: Path) -> list[str]:
+    """Check PDFs made from a book in every PDF mode against the golden copy."""
+    golden = GOLDEN / variant / "pdf.json"
+    if not golden.exists():
+        return [
+            "there is no golden PDF structure, "
+            f"create it with --update -v {variant} (needs WeasyPrint)"
+        ]
+    expected = json.loads(golden.read_text())
+    return [
+        f"PDF structure differs (makepdf {mode})"
+        for mode in PDF_MODES
+        if build_pdf(book, variant, mode, workdir) != expected
+    ]
+
+
+def check(variants: list[str], modes: list[str], pdfs: bool, workdir: Path) -> int:
+    """Check every variant in every mode, returning the number of failures."""
+    failures = 0
+    for variant in variants:
+        expected = load_golden(variant)
+        for mode in modes:
+            if mode == "incremental":
+                book, problems = build_incremental(variant, workdir)
+            else:
+                book, problems = build(variant, mode, workdir), []
+            problems.extend(compare(expected, generated_files(book)))
+            if pdfs and variant in PDF_VARIANTS and mode == "sequential":
+                problems.extend(check_pdf(book, variant, workdir))
+            status = "FAIL" if problems else "ok"
+            print(f"{variant:12} {mode:16} {status}")
+            for p in problems:
+                print(f"    {p}")
+            failures += bool(problems)
+            shutil.rmtree(book)
+    return failures
+
+
+def check_wordfilter() -> list[str]:
+    """Check the default word list filters the expected words."""
+    wordfilter = default_filter()
+    return [
+        f"-F turns {text!r} into {wordfilter(text)!r}, expected {expected!r}"
+        for text, expected in WORDFILTER_CASES.items()
+        if wordfilter(text) != expected
+    ]
+
+
+def link_part(pdffile: Path, songs: list[str], links: list[str]) -> set[str]:
+    """Write a PDF like a part of a book rendered on its own by makepdf.
+
+    Each song gets a page with a named destination. The first page links to
+    each of the links, and any link target that is not one of the songs gets
+    a placeholder destination, as WeasyPrint would only keep links to
+    destinations in the same document. Returns the placeholder names.
+    """
+    from pypdf import PdfWriter  # type: ignore
+    from pypdf.generic import (  # type: ignore
+        ArrayObject,
+        DictionaryObject,
+        FloatObject,
+        NameObject,
+        TextStringObject,
+    )
+
+    writer = PdfWriter()
+    for song in songs:
+        writer.add_blank_page(100, 100)
+        writer.add_named_destination(song, len(writer.pages) - 1)
+    placeholders = {link for link in links if link not in songs}
+    for name in sorted(placeholders):
+        writer.add_named_destination(name, 0)
+
+    annots = ArrayObject()
+    for link in links:
+        annot = DictionaryObject({
+            NameObject("/Type"): NameObject("/Annot"),
+            NameObject("/Subtype"): NameObject("/Link"),
+            NameObject("/Rect"): ArrayObject([FloatObject(n) for n in (0, 0, 10, 10)]),
+            NameObject("/A"): DictionaryObject({
+                NameObject("/S"): NameObject("/GoTo"),
+                NameObject("/D"): TextStringObject(link),
+            }),
+        })
+        annots.append(writer._add_object(annot))
+    writer.pages[0][NameObject("/Annots")] = annots
+    writer.write(pdffile)
+    return placeholders
+
+
+def check_pdfmerge(workdir: Path) -> list[str]:
+    """Check links between separately rendered parts work once merged."""
+    try:
+        from ukebook_md import pdfmerge
+    except ImportError as E:
+        print(f"Skipping PDF merge check: {E}")
+        return []
+
+    first, second = workdir / "part1.pdf", workdir / "part2.pdf"
+    parts = [
+        (first, link_part(first, ["song_a", "song_b"], ["song_c", "song_b"])),
+        (second, link_part(second, ["song_c"], ["song_a", "song_x"])),
+    ]
+    pdfmerge.merge(parts, workdir / "merged.pdf")
+    # links to songs in the other part resolve, song_x is not defined
+    # anywhere so its link is dropped, as WeasyPrint would have done
+    expected = {
+        "pages": [["page 2", "page 1"], [], ["page 0"]],
+        "destinations": {"song_a": 0, "song_b": 1, "song_c": 2},
+    }
+    structure = pdf_structure(workdir / "merged.pdf")
+    actual = {
+        "pages": [page["links"] for page in structure["pages"]],
+        "destinations": structure["destinations"],
+    }
+    if actual != expected:
+        return [f"merged PDF links are {actual}, expected {expected}"]
+    return []
+
+
+def main():
+    """Run the comparisons."""
+    opts = parse_cmdline(sys.argv[1:])
+    variants = opts.variant or list(VARIANTS)
+    modes = opts.mode or list(MODES)
+    pdfs = not opts.no_pdf and pdf_available()
+
+    with tempfile.TemporaryDirectory(prefix="ukebook-golden-") as td:
+        if opts.update:
+            update(variants, pdfs, Path(td))
+            sys.exit(0)
+        failures = check(variants, modes, pdfs, Path(td))
+        problems = check_pdfmerge(Path(td))
+
+    problems.extend(check_wordfilter())
+    for p in problems:
+        print(f"FAIL {p}")
+    failures += len(problems)
+
+    if failures:
+        print(f"{failures} build(s) differ from the golden output")
+        sys.exit(1)
+    print("All builds match the golden output")
+
+
+if __name__ == "__main__":
+    main()
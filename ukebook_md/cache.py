@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Persistent, content-addressed caching for songbook builds."""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from collections.abc import Iterable
+from functools import cache
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+# bump this whenever the structure of cached data changes, so that stale
+# entries are ignored rather than loaded
+CACHE_VERSION = 2
+
+# default upper limit on the size of the song cache, in bytes
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# default upper limit on the size of the PDF cache, in bytes
+DEFAULT_PDF_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def default_cache_dir() -> Path:
+    """Return the base directory for persistent caches.
+
+    Honours $XDG_CACHE_HOME, falling back to ~/.cache
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "ukebook_md"
+
+
+def package_version(name: str) -> str:
+    """Return the installed version of a package, or 'unknown'."""
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def digest(*parts: bytes | str) -> str:
+    """Generate a hex digest from the provided parts."""
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p.encode() if isinstance(p, str) else p)
+        # separator, so ("ab", "c") and ("a", "bc") do not collide
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+@cache
+def code_version() -> str:
+    """Return a version identifying the code of ukebook_md itself.
+
+    The installed version does not change when running from a source
+    checkout (or an editable install), so a digest of the source is added.
+    """
+    sources = sorted(Path(__file__).parent.glob("*.py"))
+    return "-".join([
+        package_version("ukebook-md"),
+        digest(*[p.read_bytes() for p in sources])[:16],
+    ])
+
+
+class SongCache:
+    """On-disk cache of parsed songsheets.
+
+    Entries are keyed on the content of the songsheet and the options and
+    library versions that affect parsing, so renaming or touching a file
+    does not invalidate it, but any edit does.
+
+    Eviction is least-recently-used, based on file modification times, and
+    happens when `prune` is called.
+    """
+
+    def __init__(self, cachedir: Path, max_size: int = DEFAULT_CACHE_SIZE):
+        """Create a cache in the given directory.
+
+        Args:
+            cachedir(Path): where to store cache entries
+            max_size(int): maximum total size of entries, in bytes
+        """
+        self.cachedir = Path(cachedir)
+        self.max_size = max_size
+        # everything except the songsheet itself that changes parse output
+        self.salt = "|".join([
+            str(CACHE_VERSION),
+            code_version(),
+            package_version("markdown"),
+            package_version("ukedown"),
+        ])
+
+    def key(self, raw: bytes, wordfilter: str = "") -> str:
+        """Generate a cache key for raw songsheet content.
+
+        Args:
+            raw(bytes): undecoded content of a songsheet
+            wordfilter(str): digest of the word list used to clean up
+                             language, if any
+        """
+        return digest(self.salt, wordfilter, raw)
+
+    def _path(self, key: str) -> Path:
+        return self.cachedir / key[:2] / f"{key}.pickle"
+
+    def get(self, key: str) -> dict | None:
+        """Load a cached entry, returns None on a miss."""
+        entry = self._path(key)
+        try:
+            data = pickle.loads(entry.read_bytes())
+            # mark as recently used
+            os.utime(entry)
+        except (
+            OSError,
+            pickle.UnpicklingError,
+            EOFError,
+            # entries referring to classes or modules that have since moved
+            AttributeError,
+            ImportError,
+        ):
+            return None
+        return data
+
+    def put(self, key: str, data: dict):
+        """Store an entry in the cache.
+
+        Writes are atomic, so concurrent workers cannot see partial entries.
+        Failure to write is not fatal, we just lose the cached copy.
+        """
+        entry = self._path(key)
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=entry.parent, delete=False, suffix=".tmp"
+            ) as tmp:
+                pickle.dump(data, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp.name, entry)
+        except OSError:
+            pass
+
+    def prune(self) -> int:
+        """Evict least-recently-used entries until under the size limit.
+
+        Returns:
+            int: number of entries removed
+        """
+        return prune(self.cachedir.glob("*/*.pickle"), self.max_size)
+
+
+class PdfCache:
+    """On-disk cache of documents laid out by WeasyPrint, as PDF files.
+
+    Keys are generated by the caller (see makepdf.part_key), and must cover
+    everything that affects layout. Eviction works as for SongCache.
+    """
+
+    def __init__(self, cachedir: Path, max_size: int = DEFAULT_PDF_CACHE_SIZE):
+        """Create a cache in the given directory.
+
+        Args:
+            cachedir(Path): where to store cache entries
+            max_size(int): maximum total size of entries, in bytes
+        """
+        self.cachedir = Path(cachedir)
+        self.max_size = max_size
+
+    def _path(self, key: str) -> Path:
+        return self.cachedir / key[:2] / f"{key}.pdf"
+
+    def get(self, key: str) -> Path | None:
+        """Return the cached PDF for a key, None on a miss."""
+        entry = self._path(key)
+        try:
+            # mark as recently used
+            os.utime(entry)
+        except OSError:
+            return None
+        return entry
+
+    def put(self, key: str, pdffile: Path):
+        """Store a copy of a PDF in the cache.
+
+        Writes are atomic, and failure to write is not fatal.
+        """
+        entry = self._path(key)
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            with (
+                tempfile.NamedTemporaryFile(
+                    dir=entry.parent, delete=False, suffix=".tmp"
+                ) as tmp,
+                open(pdffile, "rb") as src,
+            ):
+                shutil.copyfileobj(src, tmp)
+            os.replace(tmp.name, entry)
+        except OSError:
+            pass
+
+    def prune(self) -> int:
+        """Evict least-recently-used entries until under the size limit.
+
+        Returns:
+            int: number of entries removed
+        """
+        return prune(self.cachedir.glob("*/*.pdf"), self.max_size)
+
+
+def prune(entries: Iterable[Path], max_size: int) -> int:
+    """Remove least-recently-used cache entries until under a size limit.
+
+    Args:
+        entries(Iterable[Path]): cache entries, recently used ones have
+                                 recent modification times
+        max_size(int): maximum total size of entries, in bytes
+
+    Returns:
+        int: number of entries removed
+    """
+    stats = []
+    for e in entries:
+        try:
+            st = e.stat()
+        except OSError:
+            continue
+        stats.append((st.st_mtime, st.st_size, e))
+
+    total = sum(size for _, size, _ in stats)
+    removed = 0
+    for _, size, e in sorted(stats, key=lambda x: x[0]):
+        if total <= max_size:
+            break
+        try:
+            e.unlink()
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def replace_file(target: Path, content: str):
+    """Write a file by replacing it, rather than writing to the existing file.
+
+    Chord diagrams in books may be hardlinks to ChordStore entries, writing
+    to those would change the stored diagram in every book that uses it.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w", dir=target.parent, delete=False, prefix=f".{target.name}.", suffix=".tmp"
+    ) as tmp:
+        tmp.write(content)
+    try:
+        # temporary files are private, but books are often published
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, target)
+    except OSError:
+        os.unlink(tmp.name)
+        raise
+
+
+class ChordStore:
+    """Content-addressed store of rendered chord diagrams, shared by books.
+
+    Diagrams are keyed on the chord definition, fretboard layout and template
+    used to draw them (see ChordRenderer.key), so they are only rendered once
+    whatever book they are used in. Books get hardlinks to stored diagrams,
+    or copies where hardlinks are not possible (e.g. across filesystems).
+
+    Stored files are never modified once written, and files in books are
+    replaced rather than written to (see replace_file), so changing one
+    cannot affect another.
+    """
+
+    def __init__(self, cachedir: Path):
+        """Create a store in the given directory."""
+        self.cachedir = Path(cachedir)
+
+    def path(self, key: str) -> Path:
+        """Return where the diagram for a key is (or would be) stored."""
+        return self.cachedir / key[:2] / f"{key}.svg"
+
+    def get(self, key: str) -> Path | None:
+        """Return the stored diagram for a key, None on a miss."""
+        entry = self.path(key)
+        return entry if entry.is_file() else None
+
+    def put(self, key: str, svg: str) -> Path | None:
+        """Store a diagram, returns its path or None if it cannot be written."""
+        entry = self.path(key)
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=entry.parent, delete=False, suffix=".tmp"
+            ) as tmp:
+                tmp.write(svg)
+            # temporary files are private, but books are often published
+            os.chmod(tmp.name, 0o644)
+            os.replace(tmp.name, entry)
+        except OSError:
+            return None
+        return entry
+
+    @staticmethod
+    def install(entry: Path, target: Path) -> bool:
+        """Link (or copy) a stored diagram into a book, if it has changed.
+
+        Existing files with the same content are left alone, so mtimes stay
+        stable for incremental builds and anything syncing the output.
+        Otherwise the target is replaced atomically.
+
+        Returns:
+            bool: True if the target was replaced
+        """
+        try:
+            if target.samefile(entry) or target.read_bytes() == entry.read_bytes():
+                return False
+        except OSError:
+            pass
+        tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+        try:
+            tmp.unlink(missing_ok=True)
+            try:
+                os.link(entry, tmp)
+            except OSError:
+                shutil.copyfile(entry, tmp)
+            os.replace(tmp, target)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return True
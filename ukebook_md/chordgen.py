@@ -2,30 +2,23 @@
 """Generate SVG chord images."""
 
 import argparse
-
-# , PackageLoader
+import json
 import re
 import sys
+from functools import cache
 from pathlib import Path
 
+import jinja2
 import yaml
-from jinja2 import ChoiceLoader, Environment, FileSystemLoader
+from jinja2 import meta
 from progress.bar import Bar  # type: ignore
 
-# two-way mapping of equivalent non-naturals, to allow a chord to be
-# defined in more than one way (possibly to reduce duplication)
-alt_names = {
-    "A#": "Bb",
-    "Bb": "A#",
-    "C#": "Db",
-    "Db": "C#",
-    "D#": "Eb",
-    "Eb": "D#",
-    "F#": "Gb",
-    "Gb": "F#",
-    "G#": "Ab",
-    "Ab": "G#",
-}
+from ukebook_md.cache import ChordStore, default_cache_dir, digest, replace_file
+from ukebook_md.chordindex import ChordIndex, root_spellings
+from ukebook_md.templating import TEMPLATE_CACHE, get_environment
+
+# default fretboard layout
+FRETBOARD = Path(__file__).parent / "fretboard.yml"
 
 
 def parse_cmdline(argv: list[str]):
@@ -49,6 +42,19 @@ def parse_cmdline(argv: list[str]):
         type=str,
         help="chord template (jinja2) - used for rendering chords as SVG",
     )
+    parser.add_argument(
+        "--sprite",
+        action="store_true",
+        default=False,
+        help="write a single sprite sheet (DESTDIR/sprite.svg) instead of "
+        "one file per chord",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="report duplicate and unusable chord definitions, then exit",
+    )
     parser.add_argument(
         "-d",
         "--destdir",
@@ -56,6 +62,18 @@ def parse_cmdline(argv: list[str]):
         type=Path,
         help="output directory for chord (SVG) files",
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=default_cache_dir(),
+        help="where to store compiled templates (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Do not keep compiled templates",
+    )
 
     bgrp = parser.add_argument_group(
         "Fretboard Layout", "Customise frets, strings and spacing"
@@ -89,6 +107,10 @@ def parse_cmdline(argv: list[str]):
     return opts
 
 
+# shared renderers, see get_renderer
+_renderers: dict[tuple[str, str, str], "ChordRenderer"] = {}
+
+
 def symbolise(name):
     """Replace pretend symbols with real ones (unicode ftw)."""
     translations = {
@@ -113,13 +135,40 @@ def safe_name(chord):
     return chord.translate({ord(k): v for k, v in transtable.items()})
 
 
-def merge_ctx(base: dict, **kwargs) -> dict:
-    """Create a merged context for passing into jinja template.
+def symbol_id(chord: str) -> str:
+    """Generate the id of a chord's symbol in a sprite sheet.
+
+    Ids must be valid XML names, so this goes further than safe_name
+    """
+    transtable = {
+        "+": "_plus_",
+        "*": "_star_",
+        ",": "_comma_",
+    }
+    name = safe_name(chord).translate({ord(k): v for k, v in transtable.items()})
+    return f"chord_{name}"
+
+
+def template_sources(env: jinja2.Environment, template: str) -> list[str]:
+    """Return the source of a template and every template it includes."""
+    if env.loader is None:
+        # templates cannot be loaded by name, so there are none to include
+        return []
+    source = env.loader.get_source(env, template)[0]
+    sources = [source]
+    for name in sorted(filter(None, meta.find_referenced_templates(env.parse(source)))):
+        sources.extend(template_sources(env, name))
+    return sources
+
+
+def board_geometry(base: dict) -> dict:
+    """Calculate the layout of a fretboard, shared by every chord drawn on it.
 
     Args:
         base(dict): basic layout information, fretboard info, diag size etc
-    Kwargs:
-        name: un-translated name of chord, special symbols and all
+
+    Returns:
+        dict: base layout, plus string and fret positions and marker sizes
     """
     context = {}
     # calculate context settings.
@@ -153,6 +202,23 @@ def merge_ctx(base: dict, **kwargs) -> dict:
     context["radius"] = fgap / 4
     # centre for positioning halfway between frets
     context["centre"] = fgap / 2
+    return context
+
+
+def chord_ctx(geometry: dict, **kwargs) -> dict:
+    """Create the context for a chord diagram on a precalculated fretboard.
+
+    Args:
+        geometry(dict): fretboard layout, as returned by board_geometry
+    Kwargs:
+        name: un-translated name of chord, special symbols and all
+        barre: fret number of barre, if any
+        fingers: finger positions for each string
+    """
+    context = dict(geometry)
+    frets = geometry["frets"]
+    # fgap / 2
+    centre = geometry["centre"]
 
     # caculate mid-fret positions to simplify marker stuff
     bpos = kwargs.get("barre", 0)
@@ -163,10 +229,10 @@ def merge_ctx(base: dict, **kwargs) -> dict:
         # and offset from position by radius in both x and y axes
         context["barre"] = {
             "position": kwargs["barre"],
-            "left": base["fboard"]["left"] - context["radius"],
-            "top": (frets[bpos] - context["centre"]) - context["radius"],
-            "width": base["fboard"]["right"]
-            - base["fboard"]["left"]
+            "left": geometry["fboard"]["left"] - context["radius"],
+            "top": (frets[bpos] - centre) - context["radius"],
+            "width": geometry["fboard"]["right"]
+            - geometry["fboard"]["left"]
             + (context["radius"] * 2),
             "height": context["radius"] * 2,
         }
@@ -177,12 +243,109 @@ def merge_ctx(base: dict, **kwargs) -> dict:
             context["fingers"].append(fpos)
         else:
             # we have to be relative to the barre if there is one
-            context["fingers"].append(frets[fpos + bpos] - (fgap / 2))
+            context["fingers"].append(frets[fpos + bpos] - centre)
 
     context["name"] = kwargs.get("name")
     return context
 
 
+def merge_ctx(base: dict, **kwargs) -> dict:
+    """Create a merged context for passing into jinja template.
+
+    Args:
+        base(dict): basic layout information, fretboard info, diag size etc
+    Kwargs:
+        name: un-translated name of chord, special symbols and all
+    """
+    return chord_ctx(board_geometry(base), **kwargs)
+
+
+class ChordRenderer:
+    """Render chord diagrams for one fretboard layout and template.
+
+    The fretboard geometry is calculated and the template compiled once, and
+    rendered diagrams are kept, so each distinct chord is only rendered once
+    per process, however many books it appears in.
+    """
+
+    def __init__(
+        self,
+        fretboard: dict,
+        template: str = "external_chord.svg.j2",
+        template_cache: Path | None = TEMPLATE_CACHE,
+    ):
+        """Create a renderer.
+
+        Args:
+            fretboard(dict): fretboard layout, as loaded from fretboard.yml
+            template(str): name of chord diagram template
+            template_cache(Path): where to keep compiled templates, None to disable
+        """
+        env = get_environment(cachedir=template_cache)
+        self.geometry = board_geometry(fretboard)
+        self.template = env.get_template(template)
+        # identifies everything except the chord that affects a diagram
+        self.digest = digest(
+            *template_sources(env, template),
+            json.dumps(fretboard, sort_keys=True),
+        )
+        self._svgs: dict[str, str] = {}
+
+    @staticmethod
+    def _context(chordname: str, definition: dict) -> dict:
+        ctx = dict(definition)
+        if "name" not in ctx:
+            ctx["name"] = symbolise(chordname)
+        return ctx
+
+    def key(self, chordname: str, definition: dict) -> str:
+        """Return a key identifying the diagram for a chord, see ChordStore."""
+        ctx = json.dumps(self._context(chordname, definition), sort_keys=True)
+        return digest(self.digest, ctx)
+
+    def render(self, chordname: str, definition: dict, **extra) -> str:
+        """Render the diagram for a chord.
+
+        Args:
+            chordname(str): name of the chord, as used in songsheets
+            definition(dict): fingering, barre etc, from chords.yml.
+                              Not modified.
+        Kwargs:
+            any additional template context (e.g. the id of a sprite symbol)
+        """
+        ctx = self._context(chordname, definition)
+        key = json.dumps([ctx, extra], sort_keys=True)
+        if key not in self._svgs:
+            self._svgs[key] = self.template.render(
+                chord_ctx(self.geometry, **ctx), **extra
+            )
+        return self._svgs[key]
+
+
+@cache
+def load_fretboard(path: Path = FRETBOARD) -> dict:
+    """Load a fretboard layout, once per process."""
+    return yaml.safe_load(Path(path).read_text())
+
+
+def get_renderer(
+    template: str = "external_chord.svg.j2",
+    fretboard: Path = FRETBOARD,
+    template_cache: Path | None = TEMPLATE_CACHE,
+) -> ChordRenderer:
+    """Return the shared renderer for a template and fretboard layout.
+
+    A new renderer is created if the template has changed on disk.
+    """
+    key = (template, str(fretboard), str(template_cache))
+    renderer = _renderers.get(key)
+    if renderer is None or not renderer.template.is_up_to_date:
+        renderer = _renderers[key] = ChordRenderer(
+            load_fretboard(fretboard), template, template_cache
+        )
+    return renderer
+
+
 def gen_board(spacing: float, string_count: int = 4, fret_count: int = 5) -> dict:
     """Generate a diagram based on spacing of strings and frets.
 
@@ -246,76 +409,75 @@ def get_alt_name(chord: str) -> str:
 
     if res is not None:
         root, voicing = res.groups()
-        altroot = alt_names.get(root)
-        if altroot is not None:
-            altname = f"{altroot}{voicing}"
-        else:
-            return chord
-
-        return altname
+        return f"{root_spellings(root)[-1]}{voicing}"
     return chord
 
 
 def generate(
     chordlist: list[str],
-    definitions: dict,
+    definitions: dict | ChordIndex,
     destdir: Path = Path("chords"),
     template: str = "external_chord.svg.j2",
+    fretboard: Path = FRETBOARD,
+    store: ChordStore | None = None,
+    template_cache: Path | None = TEMPLATE_CACHE,
 ):
     """Generate chord diagrams based on a definitions file.
 
     Args:
         chordlist(list [str]): list of chord names to generate
-        definitions(dict): dictionary describing chords (fret positions etc)
+        definitions(dict): dictionary describing chords (fret positions etc),
+                           or a ChordIndex of them
 
     Kwargs:
         destdir(str): output directory  for chord diagrams
+        template(str): chord diagram template
+        fretboard(Path): fretboard layout (YAML)
+        store(ChordStore): shared store of diagrams, linked into destdir
+        template_cache(Path): where to keep compiled templates, None to disable
     """
     if not destdir.is_dir():
         try:
             destdir.mkdir(exist_ok=True, parents=True)
         except OSError as E:
             print(f"Cannot create output directory {E.filename} ({E.strerror})")
-    cfg: dict = {}
 
     try:
-        cfg.update(
-            yaml.safe_load((Path(__file__).parent / "fretboard.yml").read_text())
-        )
+        renderer = get_renderer(template, fretboard, template_cache)
     except OSError:
         print("unable to load fretboard template, aborting")
         sys.exit(5)
 
-    env = Environment(
-        loader=ChoiceLoader([
-            FileSystemLoader(Path(__file__).parent / "templates"),
-        ])
+    index = (
+        definitions if isinstance(definitions, ChordIndex) else ChordIndex(definitions)
     )
-    tpl = env.get_template(template)
-
     missing = set([])
 
     print("progress")
     pbar = Bar("{:20}".format("Rendering Chords:"), max=len(chordlist))
     try:
         for chordname in pbar.iter(chordlist):
-            if chordname in definitions:
-                ch = definitions.get(chordname)
-            else:
-                altname = get_alt_name(chordname)
-                ch = definitions.get(altname)
-
+            ch = index.get(chordname)
             if ch is None:
                 missing.add(chordname)
                 continue
 
-            if "name" not in ch:
-                ch["name"] = symbolise(chordname)
-
             # replaces characters that cause shell problems
             chordfile = (destdir / safe_name(chordname)).with_suffix(".svg")
 
-            chordfile.write_text(tpl.render(merge_ctx(cfg, **ch)))
+            if store is not None:
+                key = renderer.key(chordname, ch)
+                entry = store.get(key) or store.put(key, renderer.render(chordname, ch))
+                if entry is not None:
+                    store.install(entry, chordfile)
+                    continue
+
+            svg = renderer.render(chordname, ch)
+            # only write changed diagrams, keeps mtimes stable for incremental
+            # builds and anything syncing the output directory. Replaced, as
+            # the existing file may be linked to a stored diagram
+            if not chordfile.exists() or chordfile.read_text() != svg:
+                replace_file(chordfile, svg)
 
     except OSError:
         print(f"Failed to render {chordname}")
@@ -324,26 +486,102 @@ def generate(
     return missing
 
 
+def generate_sprite(
+    chordlist: list[str],
+    definitions: dict | ChordIndex,
+    destfile: Path = Path("chords/sprite.svg"),
+    template: str = "chord_symbol.svg.j2",
+    fretboard: Path = FRETBOARD,
+    template_cache: Path | None = TEMPLATE_CACHE,
+):
+    """Generate a sprite sheet, with one SVG symbol per chord.
+
+    Pages refer to diagrams as sprite.svg#<symbol id>, so a whole book needs
+    only one download for its diagrams. See symbol_id.
+
+    Args:
+        chordlist(list [str]): list of chord names to include
+        definitions(dict): dictionary describing chords (fret positions etc),
+                           or a ChordIndex of them
+
+    Kwargs:
+        destfile(Path): sprite sheet to write
+        template(str): template for each symbol
+        fretboard(Path): fretboard layout (YAML)
+        template_cache(Path): where to keep compiled templates, None to disable
+
+    Returns:
+        set: chords with no definition, which are left out
+    """
+    index = (
+        definitions if isinstance(definitions, ChordIndex) else ChordIndex(definitions)
+    )
+    try:
+        renderer = get_renderer(template, fretboard, template_cache)
+    except OSError:
+        print("unable to load fretboard template, aborting")
+        sys.exit(5)
+
+    missing = set([])
+    symbols = []
+    for chordname in sorted(chordlist):
+        ch = index.get(chordname)
+        if ch is None:
+            missing.add(chordname)
+            continue
+        symbols.append(renderer.render(chordname, ch, id=symbol_id(chordname)))
+
+    sprite = (
+        get_environment(cachedir=template_cache)
+        .get_template("chord_sprite.svg.j2")
+        .render(symbols=symbols)
+    )
+    # only write a changed sprite sheet, as for individual diagrams
+    destfile.parent.mkdir(exist_ok=True, parents=True)
+    if not destfile.exists() or destfile.read_text() != sprite:
+        replace_file(destfile, sprite)
+
+    return missing
+
+
 def main():
     """Run all the prett things."""
     # we need to load a config for our chord diagram
     opts = parse_cmdline(sys.argv[1:])
     # load out chord definitions to pass into the templates
+    chorddefs = ChordIndex.load(opts.chordlist)
+
+    if opts.check:
+        problems = chorddefs.problems()
+        print("\n".join(problems) or "No problems found")
+        sys.exit(1 if problems else 0)
 
     if not opts.destdir.is_dir():
         opts.destdir.mkdir(exist_ok=True, parents=True)
 
-    chorddefs = yaml.safe_load(opts.chordlist.read_text())
-
     if not opts.chord:
-        opts.chord = chorddefs.keys()
+        opts.chord = list(chorddefs.definitions)
+
+    template_cache = None if opts.no_cache else opts.cache_dir / "templates"
 
     print("generating chords")
     # generate diagrams for the list of provided chords
     # report on any chords that were missing definitions
-    missing = generate(
-        opts.chord, chorddefs, destdir=opts.destdir, template=opts.template
-    )
+    if opts.sprite:
+        missing = generate_sprite(
+            opts.chord,
+            chorddefs,
+            destfile=opts.destdir / "sprite.svg",
+            template_cache=template_cache,
+        )
+    else:
+        missing = generate(
+            opts.chord,
+            chorddefs,
+            destdir=opts.destdir,
+            template=opts.template,
+            template_cache=template_cache,
+        )
 
     if len(missing):
         print("Could not find definition for chords: \n", "\n".join(missing))
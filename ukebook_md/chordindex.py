@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Compiled index of chord definitions.
+
+Chord names in songsheets are spelled in many ways: G# or Ab, Cmaj7 or CM7,
+Am or Amin, and slash chords (G/B) that often have no diagram of their own.
+The index expands every definition into all the spellings it answers to when
+it is built, so looking a chord up is a single dictionary access.
+
+Spellings are resolved in order of preference: the name as defined, then
+enharmonic roots and suffix aliases, then a slash chord falling back to its
+chord without the bass note.
+"""
+
+import json
+import os
+import pickle
+import re
+import tempfile
+from itertools import product
+from pathlib import Path
+
+import yaml
+from ukedown.patterns import CHORD  # type: ignore
+
+from ukebook_md.cache import digest
+
+# bump when the structure of the index changes, so cached copies are ignored
+INDEX_VERSION = 1
+
+# equivalent spellings of non-natural roots (and bass notes)
+ENHARMONICS = [
+    ["A#", "Bb"],
+    ["C#", "Db"],
+    ["D#", "Eb"],
+    ["F#", "Gb"],
+    ["G#", "Ab"],
+]
+
+# equivalent spellings of chord qualities, these replace the start of a
+# suffix, so "min7" is also "m7" and "M7" is also "maj7"
+SUFFIX_ALIASES = [
+    ["m", "min"],
+    ["maj", "M"],
+    ["aug", "+"],
+]
+
+NOTES = ["A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"]
+
+# chord names as ukedown recognises them in songsheets
+SONGSHEET_CHORD = re.compile(CHORD)
+
+# root, suffix and optional bass note of a chord name
+CHORD_NAME = re.compile(r"([A-G][#b]?)(.*?)(?:/([A-G][#b]?))?")
+
+
+def _spellings(groups: list[list[str]]) -> dict[str, list[str]]:
+    return {name: group for group in groups for name in group}
+
+
+ROOTS = _spellings(ENHARMONICS)
+QUALITIES = _spellings(SUFFIX_ALIASES)
+
+
+def root_spellings(note: str) -> list[str]:
+    """Return all spellings of a note, starting with the one given."""
+    return [note] + [n for n in ROOTS.get(note, []) if n != note]
+
+
+def suffix_spellings(suffix: str) -> list[str]:
+    """Return all spellings of a chord suffix, starting with the one given."""
+    spellings = [suffix]
+    # longest first, so "maj7" is not treated as "m" + "aj7"
+    for quality in sorted(QUALITIES, key=len, reverse=True):
+        if suffix.startswith(quality):
+            rest = suffix[len(quality) :]
+            spellings.extend(f"{q}{rest}" for q in QUALITIES[quality] if q != quality)
+            break
+    return spellings
+
+
+def spellings(name: str) -> list[str]:
+    """Return every equivalent spelling of a chord name, itself first."""
+    match = CHORD_NAME.fullmatch(name)
+    if match is None:
+        return [name]
+    root, suffix, bass = match.groups()
+    basses = root_spellings(bass) if bass else [None]
+    names = [
+        f"{r}{s}/{b}" if b else f"{r}{s}"
+        for r, s, b in product(root_spellings(root), suffix_spellings(suffix), basses)
+    ]
+    return sorted(set(names), key=names.index)
+
+
+def reachable(name: str) -> bool:
+    """Check whether a chord name can appear in a ukedown songsheet."""
+    return SONGSHEET_CHORD.fullmatch(f"({name})") is not None
+
+
+class ChordIndex:
+    """Chord definitions, indexed by every spelling they answer to."""
+
+    def __init__(self, definitions: dict):
+        """Build an index.
+
+        Args:
+            definitions(dict): chord definitions, as loaded from chords.yml.
+                               Not modified.
+        """
+        self.definitions = definitions
+        # spelling => name of definition
+        self.names: dict[str, str] = {name: name for name in definitions}
+        # definitions answering to the same spellings as an earlier one
+        self.duplicates: dict[str, list[str]] = {}
+
+        first: dict[frozenset, str] = {}
+        for name in definitions:
+            aliases = spellings(name)
+            for alias in aliases[1:]:
+                self.names.setdefault(alias, name)
+            original = first.setdefault(frozenset(aliases), name)
+            if original != name:
+                self.duplicates.setdefault(original, []).append(name)
+
+        # slash chords without a diagram of their own
+        for name in [n for n in self.names if "/" not in n]:
+            for note in NOTES:
+                for bass in root_spellings(note):
+                    self.names.setdefault(f"{name}/{bass}", self.names[name])
+
+    def __contains__(self, chordname: str) -> bool:
+        """Check whether a chord can be drawn."""
+        return chordname in self.names
+
+    def __len__(self) -> int:
+        """Return the number of spellings in the index."""
+        return len(self.names)
+
+    def resolve(self, chordname: str) -> str | None:
+        """Return the name of the definition used for a chord, if any."""
+        return self.names.get(chordname)
+
+    def get(self, chordname: str) -> dict | None:
+        """Return the definition used for a chord, None if there is none."""
+        name = self.names.get(chordname)
+        return None if name is None else self.definitions[name]
+
+    def unreachable(self) -> list[str]:
+        """Return definitions that no songsheet chord can refer to."""
+        return [name for name in self.definitions if not reachable(name)]
+
+    def problems(self) -> list[str]:
+        """Describe duplicated and unreachable definitions."""
+        report = []
+        for name, dups in self.duplicates.items():
+            same = all(self.definitions[d] == self.definitions[name] for d in dups)
+            kind = "duplicated" if same else "redefined (differently)"
+            report.append(f"{name} is {kind} as {', '.join(dups)}")
+        for name in self.unreachable():
+            report.append(f"{name} cannot be used in songsheets")
+        return report
+
+    @classmethod
+    def load(cls, chordlist: Path, cachedir: Path | None = None) -> "ChordIndex":
+        """Load and index a chord definitions file.
+
+        Args:
+            chordlist(Path): chord definitions (YAML)
+            cachedir(Path): where to keep compiled indexes, None to disable
+        """
+        raw = Path(chordlist).read_bytes()
+        if cachedir is None:
+            return cls(yaml.safe_load(raw))
+
+        key = digest(str(INDEX_VERSION), json.dumps([ENHARMONICS, SUFFIX_ALIASES]), raw)
+        entry = Path(cachedir) / f"{key}.pickle"
+        try:
+            index = pickle.loads(entry.read_bytes())
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            index = cls(yaml.safe_load(raw))
+            try:
+                entry.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    dir=entry.parent, delete=False, suffix=".tmp"
+                ) as tmp:
+                    pickle.dump(index, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp.name, entry)
+            except OSError:
+                pass
+        return index
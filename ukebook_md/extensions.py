@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Markdown extensions used when converting songsheets."""
+
+import html
+import re
+import xml.etree.ElementTree as etree
+
+from markdown import Markdown, util  # type: ignore
+from markdown.extensions import Extension  # type: ignore
+from markdown.treeprocessors import Treeprocessor  # type: ignore
+
+TAGS = re.compile(r"<[^>]+>")
+
+
+class SongInfoProcessor(Treeprocessor):
+    """Extract the title line and chord names from a converted songsheet.
+
+    The first <h1> (the title line, courtesy of ukedown) is removed from the
+    document, and its text stored along with an ordered list of the unique
+    chords used, in ``md.song_info``.
+
+    This runs after everything else, so the tree is already in its final
+    form, saving a second parse of the HTML output.
+    """
+
+    def text(self, element: etree.Element) -> str:
+        """Return the plain text content of an element and its children."""
+        content = "".join(element.itertext())
+        # restore anything markdown has stashed away (entities, raw HTML)
+        # and strip it back to text
+        content = util.HTML_PLACEHOLDER_RE.sub(
+            lambda m: self.md.htmlStash.rawHtmlBlocks[int(m.group(1))], content
+        )
+        return html.unescape(TAGS.sub("", content))
+
+    def run(self, root: etree.Element):
+        """Process the document tree."""
+        info: dict = {"header": None, "chords": [], "empty": len(root) == 0}
+
+        hdr = next(root.iter("h1"), None)
+        if hdr is not None:
+            info["header"] = self.text(hdr)
+            remove(root, hdr)
+
+        for c in root.iter("span"):
+            if "chord" not in c.get("class", "").split():
+                continue
+            cname = self.text(c).split().pop(0).rstrip("*")
+            # don't add repeated chords
+            if cname not in info["chords"]:
+                info["chords"].append(cname)
+
+        self.md.song_info = info
+
+
+def remove(root: etree.Element, element: etree.Element):
+    """Remove an element from a tree, keeping any text that follows it."""
+    for parent in root.iter():
+        children = list(parent)
+        if element not in children:
+            continue
+        idx = children.index(element)
+        if element.tail and element.tail.strip():
+            if idx > 0:
+                children[idx - 1].tail = (children[idx - 1].tail or "") + element.tail
+            else:
+                parent.text = (parent.text or "") + element.tail
+        parent.remove(element)
+        return
+
+
+class SongInfoExtension(Extension):
+    """Collect song title and chord information during conversion."""
+
+    def extendMarkdown(self, md: Markdown):
+        """Register our processor with the markdown instance."""
+        self.md = md
+        md.registerExtension(self)
+        md.song_info = {}
+        # after all the built-in treeprocessors, including 'unescape' (0)
+        md.treeprocessors.register(SongInfoProcessor(md), "songinfo", -10)
+
+    def reset(self):
+        """Clear song information between documents."""
+        if getattr(self, "md", None) is not None:
+            self.md.song_info = {}
+
+
+def makeExtension(**kwargs):
+    """Create the extension, for loading by name."""
+    return SongInfoExtension(**kwargs)
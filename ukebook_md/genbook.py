@@ -4,6 +4,8 @@
 """Generate songbook in HTML format from provided ukedown inputs."""
 
 import argparse
+import hashlib
+import json
 import logging
 import os
 import re
@@ -11,21 +13,46 @@ import shutil
 
 # the normal boring stuff
 import sys
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 from glob import glob
 from operator import itemgetter
 from pathlib import Path, PosixPath
+from typing import Any
 
 # jinja2 templating, originally based on the django model.
 import jinja2
+import lxml.etree  # type: ignore
+import lxml.html  # type: ignore
 import markdown  # type: ignore
 import yaml
-
-# for generating summary info
-from bs4 import BeautifulSoup as bs
 from progress.bar import Bar  # type: ignore
 
 from ukebook_md import chordgen
+from ukebook_md.cache import (
+    DEFAULT_CACHE_SIZE,
+    ChordStore,
+    SongCache,
+    code_version,
+    default_cache_dir,
+    digest,
+    package_version,
+)
+from ukebook_md.chordindex import ChordIndex
+from ukebook_md.extensions import SongInfoExtension
+from ukebook_md.manifest import (
+    BuildManifest,
+    copy_if_changed,
+    file_digest,
+    template_digest,
+)
+from ukebook_md.profiling import SLOWEST_SONGS, Profiler, timed
+from ukebook_md.songs import Song, SongIndex
+from ukebook_md.templating import get_environment
+from ukebook_md.wordfilter import DEFAULT_WORDLIST, WordFilter, default_filter
 
 
 # local chord generation tool (SVGs)
@@ -37,6 +64,12 @@ def path_representer(dumper, data):
 
 yaml.representer.SafeRepresenter.add_representer(PosixPath, path_representer)
 yaml.representer.SafeRepresenter.add_representer(Path, path_representer)
+yaml.representer.SafeRepresenter.add_representer(
+    SongIndex, lambda dumper, data: dumper.represent_list(list(data))
+)
+yaml.representer.SafeRepresenter.add_representer(
+    Song, lambda dumper, data: dumper.represent_dict(data.as_dict())
+)
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s - %(message)s",
@@ -45,11 +78,8 @@ logging.basicConfig(
     level=logging.DEBUG,
 )
 
-SWEARING = {
-    "fuck": "forget",
-    "shit": "shoot",
-    "nigga": "trigger",
-}
+# per-process markdown converter, see get_converter
+_converter: markdown.Markdown | None = None
 
 
 def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
@@ -115,6 +145,13 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
         default=False,
         help="Use external SVG images (reduces duplication)",
     )
+    parser.add_argument(
+        "--sprite",
+        action="store_true",
+        default=False,
+        help="Put all chord diagrams in a single SVG sprite sheet, "
+        "so pages need only one download for them. Implies --external",
+    )
     parser.add_argument(
         "--png",
         action="store_true",
@@ -166,6 +203,12 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
         default=False,
         help="Clean up the language for sensitive souls",
     )
+    cgrp.add_argument(
+        "--wordlist",
+        type=Path,
+        default=DEFAULT_WORDLIST,
+        help="words to replace in family-friendly books (YAML, word: replacement)",
+    )
 
     cgrp.add_argument(
         "--no-html",
@@ -173,6 +216,12 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
         default=False,
         help="Do not regenerate HTML pages (test CSS updates for example)",
     )
+    cgrp.add_argument(
+        "--tidy",
+        action="store_true",
+        default=False,
+        help="Normalise the markup of generated song pages (slower)",
+    )
     cgrp.add_argument(
         "--no-css",
         action="store_true",
@@ -226,9 +275,9 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
     cgrp.add_argument(
         "--clean",
         dest="refresh",
-        action="store_true",
-        default=False,
-        help="remove all files from output dir before building (overrides --update)",
+        action="store_false",
+        help="ignore the record of the last build and regenerate every file "
+        "(overrides --update)",
     )
 
     pgrp = parser.add_argument_group(
@@ -304,6 +353,28 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
         help="Produce debug output in songbook directory",
     )
 
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="FILE",
+        help="record the time taken by each stage of the build, and by each "
+        "song, in FILE (JSON)",
+    )
+    parser.add_argument(
+        "--profile-songs",
+        type=int,
+        default=SLOWEST_SONGS,
+        metavar="N",
+        help="number of slowest songs to include in the profile (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        default=False,
+        help="report peak and retained memory, and the top allocation sites, "
+        "for each stage (slow). Included in the --profile report",
+    )
+
     parser.add_argument(
         "--chordlist",
         default=Path(__file__).parent / "chords.yml",
@@ -311,6 +382,44 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
         help="chord configuration file (YAML)",
     )
 
+    cachegrp = parser.add_argument_group(
+        "Caching", "Persistent caches used to speed up repeated builds"
+    )
+    cachegrp.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=default_cache_dir(),
+        help="where to store cached data (default: %(default)s)",
+    )
+    cachegrp.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+        help="maximum size of the songsheet cache in MB (default: %(default)s)",
+    )
+    cachegrp.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Do not use cached results, parse every songsheet",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes used to parse songsheets. "
+        "0 means one per CPU core (default: 1, no worker pool)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="keep only song metadata in memory, parsing and rendering each "
+        "song in turn. For very large books, fastest with the cache enabled",
+    )
+
     args = parser.parse_args(argv)
 
     if not args.output.is_dir():
@@ -324,6 +433,9 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
             f"Output directory {args.output} already exists. Will replace files in it"
         )
 
+    if args.sprite:
+        args.external = True
+
     if not args.css:
         args.css = args.topdir / "css"
 
@@ -359,6 +471,9 @@ def parse_commandline(argv: list[str] = sys.argv[1:]) -> argparse.Namespace:
 
     if not args.orientation:
         args.orientation = "portrait"
+
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
     return args
 
 
@@ -393,13 +508,31 @@ def render(template, context, template_dir="templates"):
                            default is the local 'templates' directory.
 
     """
-    j2env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
-
-    tpl = j2env.get_template(template)
+    tpl = get_environment(Path(template_dir)).get_template(template)
 
     return tpl.render(context)
 
 
+def song_id(songfile: Path) -> str:
+    """Generate a stable identifier for a songsheet.
+
+    IDs are derived from the filename, so they don't change when songs are
+    added to or removed from a book, and are safe to use in HTML/XML IDs and
+    URL fragments.
+
+    Args:
+        songfile(Path): path to songsheet
+
+    Returns:
+        str: lowercase slug of the filename, without extension
+    """
+    slug = re.sub(r"[\W_]+", "-", songfile.stem.lower()).strip("-")
+    if not slug:
+        # nothing usable in the filename, fall back to a hash of it
+        slug = hashlib.blake2s(songfile.name.encode(), digest_size=6).hexdigest()
+    return slug
+
+
 def parse_meta(markup, leader=";"):
     """Parse out metadata from UDN file.
 
@@ -426,29 +559,75 @@ def parse_meta(markup, leader=";"):
     return _metadata, _markup
 
 
-def ukedown_to_html(inputfile: Path, family_friendly: bool = False) -> tuple[str, dict]:
-    """Process a file, produce HTML via ukedown."""
-    fh = inputfile.open()
-    raw_markup = fh.read()
-    if family_friendly:
-        for k, v in SWEARING.items():
-            if raw_markup.find(k):
-                raw_markup = raw_markup.replace(k, v)
-            if raw_markup.find(k.title()) != -1:
-                raw_markup = raw_markup.replace(k.title(), v.title())
+def get_converter() -> markdown.Markdown:
+    """Return the markdown converter for this process.
+
+    Setting up markdown and its extensions is expensive compared to
+    converting a single songsheet, so we create one converter per process
+    and reset it between songs. Worker processes each get their own.
+    """
+    global _converter
+    if _converter is None:
+        _converter = markdown.Markdown(
+            extensions=[
+                "markdown.extensions.nl2br",
+                "ukedown.udn",
+                SongInfoExtension(),
+            ]
+        )
+    return _converter
+
 
-    mtime = os.path.getmtime(inputfile)
+def ukedown_to_html(
+    raw_markup: str,
+    family_friendly: bool = False,
+    wordfilter: WordFilter | None = None,
+) -> tuple[str, dict, dict]:
+    """Process songsheet content, produce HTML via ukedown.
+
+    Args:
+        raw_markup(str): ukedown content of a songsheet
+        family_friendly(bool): clean up language
+        wordfilter(WordFilter): replacements to use when cleaning up
+                                language, defaults to the built-in list
+
+    Returns:
+        tuple: HTML (without the title line), metadata, and song information
+               collected during conversion (header text and chords used)
+    """
+    if family_friendly:
+        raw_markup = (wordfilter or default_filter())(raw_markup)
 
     meta, markup = parse_meta(raw_markup, leader=";")
     if meta is None:
         meta = {}
-    meta["last_modified"] = int(mtime)
 
-    return (
-        markdown.markdown(
-            markup, extensions=["markdown.extensions.nl2br", "ukedown.udn"]
-        ),
-        meta,
+    md = get_converter()
+    content = md.reset().convert(markup)
+
+    return content, meta, md.song_info
+
+
+def tidy_html(page: Path, xhtml: bool = False):
+    """Normalise the markup of a generated HTML page, in place.
+
+    Fixes up missing or misplaced elements and attribute quoting, as the
+    BeautifulSoup pass that song pages used to go through did, but using
+    lxml directly, which is considerably cheaper.
+
+    Args:
+        page(Path): HTML file to rewrite
+        xhtml(bool): write well-formed XHTML (for EPUB) rather than HTML
+    """
+    doc = lxml.html.parse(str(page), parser=lxml.html.HTMLParser(encoding="utf-8"))
+    if not xhtml:
+        page.write_bytes(lxml.html.tostring(doc, encoding="utf-8"))
+        return
+    # the HTML parser keeps xmlns as a plain attribute, and libxml2 adds it
+    # again when serialising a page with an XHTML doctype
+    doc.getroot().attrib.pop("xmlns", None)
+    page.write_bytes(
+        lxml.etree.tostring(doc, method="xml", encoding="utf-8", xml_declaration=True)
     )
 
 
@@ -472,46 +651,41 @@ def create_layout(destdir, *subdirs):
             sys.exit(1)
 
 
-def parse_song(songfile: Path, songid: int = 1, **kwargs) -> dict:
-    """Process an individual songsheet to extract content and metadata.
+def parse_content(
+    raw_markup: str,
+    family_friendly: bool = False,
+    wordfilter: WordFilter | None = None,
+) -> dict:
+    """Parse songsheet content into HTML, metadata and chords.
+
+    This depends only on the content and options, not the file it came from,
+    so the results can be cached.
 
     Args:
-        songfile(str): path to songsheet file.
-        songid(int): unique identifier
+        raw_markup(str): ukedown content of a songsheet
+        family_friendly(bool): clean up language
+        wordfilter(WordFilter): replacements to use when cleaning up language
 
     Returns:
-        songdata(dict): dictionary representation of a song for use
-                        in templating/reporting
+        dict: html, title, artist, chords and meta entries for a song
     """
-    songdata: dict = {
-        "filename": songfile.with_suffix(".html"),
-        "chords": [],
-        "id": f"{songid:03d}",
-        "next_id": f"{songid + 1:03d}",
-        "prev_id": f"{songid - 1:03d}",
-        "meta": {},
-    }
-    # convert ukedown to HTML - this generates a complete document, we only
-    # need the HTML <body> element, will extract that later
-    content, meta = ukedown_to_html(
-        songfile, family_friendly=kwargs.get("family_friendly", False)
+    parsed: dict = {"chords": [], "meta": {}}
+    # convert ukedown to HTML. The title line and the chords used are
+    # collected during conversion
+    content, meta, info = ukedown_to_html(
+        raw_markup, family_friendly=family_friendly, wordfilter=wordfilter
     )
     if meta is not None:
-        songdata["meta"].update(meta)
-
-    # process our HTML with BeautifulSoup4
-    soup: bs = bs(content, features="lxml")
+        parsed["meta"].update(meta)
 
-    # title and artist are in <h1> tags.
-    hdr = soup.h1
+    # title and artist are in the <h1> header
+    hdr = info["header"]
     if hdr is not None:
         try:
-            title, artist = (i.strip() for i in hdr.text.split("-", 1))
+            title, artist = (i.strip() for i in hdr.split("-", 1))
         except ValueError:
-            title = hdr.text.strip()
+            title = hdr.strip()
             artist = None
-        # remove the header from our document
-        hdr.decompose()
     else:
         title = "Unknown Title"
         artist = "Unknown Artist"
@@ -520,23 +694,81 @@ def parse_song(songfile: Path, songid: int = 1, **kwargs) -> dict:
     artist = meta.get("artist", artist)
 
     # currently all the templates use 'html', so stick to that naming
-    if soup.body is not None:
-        songdata["html"] = "".join([str(x) for x in soup.body.contents]).strip()
+    parsed["html"] = content.strip()
+    if not info["empty"]:
         # every valid ukedown songsheet has a title, and possibly an artist
-        songdata["title"] = title.strip()
+        parsed["title"] = title.strip()
         if artist is not None:
-            songdata["artist"] = artist.strip()
-    else:
-        songdata["html"] = ""
+            parsed["artist"] = artist.strip()
+
+    # list of chords used in the song, in order of appearance
+    parsed["chords"] = info["chords"]
+    return parsed
+
+
+def parse_song(songfile: Path, songid: str | None = None, **kwargs) -> Song:
+    """Process an individual songsheet to extract content and metadata.
+
+    Args:
+        songfile(str): path to songsheet file.
+        songid(str): unique identifier, generated from the filename if not
+                     provided. prev_id and next_id are set by the caller,
+                     as they depend on the rest of the book.
+
+    Kwargs:
+        family_friendly(bool): clean up language
+        wordfilter(WordFilter): replacements to use when cleaning up language
+        cache(SongCache): cache of previously parsed songsheets
+        metadata_only(bool): discard the HTML content once parsed
+
+    Returns:
+        Song: song record for use in templating/reporting
+    """
+    family_friendly = kwargs.get("family_friendly", False)
+    wordfilter = kwargs.get("wordfilter") or default_filter()
+    cache = kwargs.get("cache")
+
+    raw = songfile.read_bytes()
+    parsed = None
+    if cache is not None:
+        key = cache.key(raw, wordfilter.digest if family_friendly else "")
+        parsed = cache.get(key)
+
+    if parsed is None:
+        parsed = parse_content(
+            raw.decode(), family_friendly=family_friendly, wordfilter=wordfilter
+        )
+        if cache is not None:
+            cache.put(key, parsed)
+
+    parsed["meta"]["last_modified"] = int(os.path.getmtime(songfile))
+
+    return Song(
+        songid or song_id(songfile),
+        songfile,
+        title=parsed.get("title", ""),
+        artist=parsed.get("artist", ""),
+        html=None if kwargs.get("metadata_only", False) else parsed["html"],
+        chords=parsed["chords"],
+        meta=parsed["meta"],
+    )
 
-    # now get list of chords used in the song
-    songdata["chords"] = []
-    for c in soup.findAll("span", {"class": "chord"}):
-        cname = c.text.split().pop(0).rstrip("*")
-        # don't add repeated chords
-        if cname not in songdata["chords"]:
-            songdata["chords"].append(cname)
-    return songdata
+
+def with_content(song: Song, **kwargs) -> Song:
+    """Return a song with its HTML content, parsing it again if necessary.
+
+    Songs parsed with metadata_only are returned as a copy, so the content
+    can be discarded as soon as the page is rendered.
+
+    Args:
+        song(Song): song, as returned by parse_song
+
+    Kwargs:
+        as for parse_song
+    """
+    if song.html is not None:
+        return song
+    return song.replace(html=parse_song(song.source, song.id, **kwargs).html)
 
 
 def parse_songsheets(inputs: list, exclusions: list[Path] | None, **kwargs) -> dict:
@@ -546,8 +778,18 @@ def parse_songsheets(inputs: list, exclusions: list[Path] | None, **kwargs) -> d
         inputdirs(list): list of directories containing input files in
                          ukedown format
         exclusions(list):
+
+    Kwargs:
+        family_friendly(bool): clean up language in songsheets
+        wordfilter(WordFilter): replacements to use when cleaning up language
+        jobs(int): number of worker processes to parse songsheets with.
+                   Songs are still returned in sorted order.
+        cache(SongCache): cache of previously parsed songsheets
+        metadata_only(bool): do not keep song content (see with_content)
+        profiler(Profiler): records the time taken to parse each song
     Returns:
-        context(dict): artist, title, chords etc parsed from songsheet
+        context(dict): chords used in the book, and a SongIndex of songs
+                       (artist, title, chords etc parsed from songsheet)
     """
     songs = {}
     # will merge dirs together, if a song appears twice, last match wins
@@ -558,31 +800,75 @@ def parse_songsheets(inputs: list, exclusions: list[Path] | None, **kwargs) -> d
             # for single songsheets, just the file info
             songs.update({src.name: src})
 
-    context: dict = {"chords": set([]), "songs": []}
-    # we would like to maintain chord ordering
-    # chords are listed in the order they appear in the song.
-    pbar = Bar("Analysing Content: ".ljust(20), max=len(songs))
     # This will sort items across multiple directories
-    for sng, path in sorted(songs.items(), key=itemgetter(0)):
-        # skip songs/paths we have specifically excluded
-        if exclusions is not None and (sng in exclusions or path in exclusions):
-            continue
+    # skip songs/paths we have specifically excluded
+    songfiles = [
+        path
+        for sng, path in sorted(songs.items(), key=itemgetter(0))
+        if exclusions is None or not (sng in exclusions or path in exclusions)
+    ]
 
-        # parse the songsheet to get metadata and HTML (sd=songdata)
-        sd = parse_song(
-            path, pbar.index, family_friendly=kwargs.get("family_friendly", False)
-        )
+    context: dict = {"chords": set([]), "songs": SongIndex()}
+    # we would like to maintain chord ordering
+    # chords are listed in the order they appear in the song.
+    pbar = Bar("Analysing Content: ".ljust(20), max=len(songfiles))
+
+    # parse the songsheet to get metadata and HTML (sd=songdata)
+    cache = kwargs.get("cache")
+    parser = partial(
+        parse_song,
+        family_friendly=kwargs.get("family_friendly", False),
+        wordfilter=kwargs.get("wordfilter"),
+        cache=cache,
+        metadata_only=kwargs.get("metadata_only", False),
+    )
+    jobs = kwargs.get("jobs", 1)
+    profiler = kwargs.get("profiler")
+    work: Callable[[Path], Any] = parser
+    if profiler is not None:
+        # time songs where they are parsed, which may be in a worker process
+        work = partial(timed, parser)
+
+    with (
+        ProcessPoolExecutor(max_workers=jobs, initializer=get_converter)
+        if jobs > 1
+        else nullcontext()
+    ) as pool:
+        results: Iterator[Any]
+        if pool is None:
+            results = map(work, songfiles)
+        else:
+            # Executor.map yields results in submission order, so the output
+            # is identical to the sequential version
+            chunksize = max(1, len(songfiles) // (jobs * 4))
+            results = pool.map(work, songfiles, chunksize=chunksize)
+
+        for result in results:
+            sd: Song
+            if profiler is not None:
+                sd, wall, cpu = result
+                profiler.record_song(sd.source.name, "parse", wall, cpu)
+            else:
+                sd = result
+            # filenames are unique, but their slugs may not be
+            if sd.id in context["songs"]:
+                sd.id = song_id(sd.source) + "-" + digest(sd.source.name)[:6]
+
+            # add any chords from this song to our global chordlist
+            context["chords"].update(sd.chords)
+
+            context["songs"].add(sd)
+            pbar.next()
+    pbar.finish()
 
-        # add any chords from this song to our global chordlist
-        context["chords"].update(sd["chords"])
+    # link each song to its neighbours
+    for sd in context["songs"]:
+        prev, nxt = context["songs"].neighbours(sd.id)
+        sd.prev_id = prev.id if prev else None
+        sd.next_id = nxt.id if nxt else None
 
-        context["songs"].append(sd)
-        pbar.next()
-        context["index"] = {
-            s["id"]: Path("../songs") / s["filename"].name for s in context["songs"]
-        }
-        # index is a mapping of title or title (artist) to song id
-    pbar.finish()
+    if cache is not None:
+        cache.prune()
     return context
 
 
@@ -610,6 +896,7 @@ def make_context(ctx: dict, options: argparse.Namespace) -> dict:
     ctx["show_credits"] = True
     ctx["show_singer"] = False
     ctx["ext_chords"] = options.external
+    ctx["sprite"] = options.sprite
     ctx["orientation"] = options.orientation
     if options.hide_diagrams:
         # this is effectively 'karauke band style'
@@ -632,6 +919,16 @@ def make_context(ctx: dict, options: argparse.Namespace) -> dict:
     return ctx
 
 
+def options_digest(ctx: dict) -> str:
+    """Generate a digest of the book-wide settings in a template context.
+
+    Args:
+        ctx(dict): template context, as generated by make_context
+    """
+    settings = {k: v for k, v in ctx.items() if k not in ("songs", "chords")}
+    return digest(json.dumps(settings, sort_keys=True, default=str))
+
+
 def main():  # noqa: C901
     """Run all the pretty things."""
     options = parse_commandline(sys.argv[1:])
@@ -641,14 +938,44 @@ def main():  # noqa: C901
     if len(options.input) == 1 and options.input[0].is_file():
         options.no_index = True
 
-    # context created by analysing input files and options:
-    context = make_context(
-        parse_songsheets(
-            options.input, options.exclude, family_friendly=options.family_friendly
-        ),
-        options,
+    profiler = Profiler(
+        "htmlbook", slowest=options.profile_songs, memory=options.memory
     )
 
+    songcache = None
+    chordstore = None
+    if not options.no_cache:
+        songcache = SongCache(
+            options.cache_dir / "songs", max_size=options.cache_size * 1024 * 1024
+        )
+        chordstore = ChordStore(options.cache_dir / "chords")
+
+    # a single page includes every song, so cannot be streamed
+    streaming = options.stream and options.format != "onepage"
+    wordfilter = None
+    if options.family_friendly:
+        wordfilter = WordFilter.from_file(options.wordlist)
+    parse_opts = {
+        "family_friendly": options.family_friendly,
+        "wordfilter": wordfilter,
+        "cache": songcache,
+    }
+
+    # context created by analysing input files and options:
+    with profiler.stage("parse_songsheets"):
+        context = make_context(
+            parse_songsheets(
+                options.input,
+                options.exclude,
+                jobs=options.jobs,
+                metadata_only=streaming,
+                # only time each song when the times are wanted
+                profiler=profiler if options.profile or options.memory else None,
+                **parse_opts,
+            ),
+            options,
+        )
+
     if options.report:
         print(
             """
@@ -682,6 +1009,8 @@ def main():  # noqa: C901
         chord_template = "chord_ext.svg.j2"
         chord_dir = options.output / "chords"
         song_template = Path("song.html.j2")
+        if options.sprite:
+            song_template = Path("song_sprite.html.j2")
     else:
         chord_template = "chord.svg.j2"
         chord_dir = Path("templates/svg")
@@ -697,13 +1026,34 @@ def main():  # noqa: C901
     tsfile = options.output / ".timestamp"
     tsfile.write_text(timestamp.strftime("%s"))
 
-    chorddefs = yaml.safe_load(options.chordlist.read_text())
+    # what each output file was built from last time, for incremental builds
+    manifest = BuildManifest(options.output, refresh=options.refresh)
+    template_cache = None if options.no_cache else options.cache_dir / "templates"
 
-    # generate all chord diagrams from the songbook context
-    missing_chords = chordgen.generate(
-        context["chords"], chorddefs, destdir=chord_dir, template=chord_template
+    chorddefs = ChordIndex.load(
+        options.chordlist,
+        cachedir=None if options.no_cache else options.cache_dir / "chordindex",
     )
 
+    # generate all chord diagrams from the songbook context
+    with profiler.stage("chordgen.generate"):
+        if options.sprite:
+            missing_chords = chordgen.generate_sprite(
+                context["chords"],
+                chorddefs,
+                destfile=chord_dir / "sprite.svg",
+                template_cache=template_cache,
+            )
+        else:
+            missing_chords = chordgen.generate(
+                context["chords"],
+                chorddefs,
+                destdir=chord_dir,
+                template=chord_template,
+                store=chordstore,
+                template_cache=template_cache,
+            )
+
     if len(missing_chords):
         print("Cannot find definitions for chords", "\n".join(missing_chords))
 
@@ -719,98 +1069,155 @@ def main():  # noqa: C901
             if key is not None:
                 context[key].append(os.path.basename(item))
 
-    # this section should be refactored to avoid repetition.
-    if options.css and not options.no_css:
-        shutil.copytree(options.css, options.output / "css", dirs_exist_ok=True)
+    with profiler.stage("copy_assets"):
+        # this section should be refactored to avoid repetition.
+        if options.css and not options.no_css:
+            shutil.copytree(
+                options.css,
+                options.output / "css",
+                dirs_exist_ok=True,
+                copy_function=copy_if_changed,
+            )
 
-    if options.images.exists():
-        shutil.copytree(options.images, options.output / "images", dirs_exist_ok=True)
-    if options.scripts.exists():
-        shutil.copytree(options.scripts, options.output / "scripts", dirs_exist_ok=True)
+        if options.images.exists():
+            shutil.copytree(
+                options.images,
+                options.output / "images",
+                dirs_exist_ok=True,
+                copy_function=copy_if_changed,
+            )
+        if options.scripts.exists():
+            shutil.copytree(
+                options.scripts,
+                options.output / "scripts",
+                dirs_exist_ok=True,
+                copy_function=copy_if_changed,
+            )
 
     # setup our template environment
-    loaders = [
-        jinja2.PackageLoader("ukebook_md"),
-    ]
-    if options.templates and options.templates.is_dir():
-        loaders.insert(0, jinja2.FileSystemLoader(options.templates))
-    env = jinja2.Environment(
-        loader=jinja2.ChoiceLoader(loaders),
+    env = get_environment(
+        *([options.templates] if options.templates else []),
+        cachedir=template_cache,
         lstrip_blocks=True,
         trim_blocks=True,
     )
     env.filters["safe_name"] = safe_name
+    env.filters["symbol_id"] = chordgen.symbol_id
 
     # now let's generate our songsheets
     st = env.get_template(song_template.name)
     css_template = env.get_template("song.css.j2")
 
+    # everything book-wide that a rendered page depends on, including the
+    # code that parses and renders songs
+    book_inputs = digest(
+        code_version(),
+        package_version("markdown"),
+        package_version("ukedown"),
+        template_digest(env),
+        file_digest(options.chordlist),
+        options_digest(context),
+        song_template.name,
+        str(options.family_friendly),
+        wordfilter.digest if wordfilter is not None else "",
+        str(options.tidy),
+    )
+    if options.format == "onepage":
+        # every page includes every song
+        book_inputs = digest(
+            book_inputs, *[file_digest(s.source) for s in context["songs"]]
+        )
+
     failures = []
     if not options.no_html:
-        if options.format == "onepage":
-            # generate index then all the other things afterwards?
-            logging.info("rendering songbook into single-page HTML")
-            if not options.no_index:
-                (options.output / "index.html").write_text(
-                    st.render(context, link_type="internal")
-                )
+        with profiler.stage("render_songs"):
+            if options.format == "onepage":
+                # generate index then all the other things afterwards?
+                logging.info("rendering songbook into single-page HTML")
+                if not options.no_index:
+                    st.stream(context, link_type="internal").dump(
+                        str(options.output / "index.html"), encoding="utf-8"
+                    )
 
-        for songobj in Bar("Rendering Songs:".ljust(20)).iter(context["songs"]):
-            logging.info("rendering {title} into {filename}".format(**songobj))
-            logging.debug("Chords: {chords!r}".format(**songobj))
-            songobj["_prev"] = context["index"].get(songobj["prev_id"], "../index.html")
-            songobj["_next"] = context["index"].get(songobj["next_id"], "../index.html")
-            songobj["book_css"] = options.style
-            songobj["context"] = context
-            if (
-                "font_size" in songobj["meta"]
-                or "landscape_font_size" in songobj["meta"]
-            ):
-                song_style = (
-                    options.output
-                    / "css"
-                    / songobj["filename"].with_suffix(".css").name
-                )
-                try:
-                    song_style.write_text(
-                        css_template.render(
-                            orientation=context["orientation"], meta=songobj["meta"]
-                        )
+            for songobj in Bar("Rendering Songs:".ljust(20)).iter(context["songs"]):
+                logging.info(f"rendering {songobj.title} into {songobj.filename}")
+                logging.debug(f"Chords: {songobj.chords!r}")
+                if "font_size" in songobj.meta or "landscape_font_size" in songobj.meta:
+                    song_style = (
+                        options.output
+                        / "css"
+                        / songobj.filename.with_suffix(".css").name
                     )
-                except jinja2.TemplateError:
-                    print(
-                        yaml.safe_dump({
-                            "orientation": context["orientation"],
-                            "meta": songobj["meta"],
-                        })
+                    style_inputs = digest(
+                        book_inputs,
+                        songobj.meta.get("font_size", ""),
+                        songobj.meta.get("landscape_font_size", ""),
                     )
-                    raise
+                    try:
+                        if not manifest.is_current(song_style, style_inputs):
+                            song_style.write_text(
+                                css_template.render(
+                                    orientation=context["orientation"],
+                                    meta=songobj.meta,
+                                )
+                            )
+                            manifest.record(song_style, style_inputs)
+                    except jinja2.TemplateError:
+                        print(
+                            yaml.safe_dump({
+                                "orientation": context["orientation"],
+                                "meta": songobj.meta,
+                            })
+                        )
+                        raise
 
-            if options.debug:
-                dumpfile = (
-                    options.output
-                    / "debug"
-                    / songobj["filename"].with_suffix(".yml").name
-                )
-                dumpfile.write_text(yaml.safe_dump(songobj))
-            try:
-                sf = options.output / "songs" / songobj["filename"].name
-                content = bs(
-                    st.render(
-                        song=songobj,
-                        **context,
-                    ),
-                    features="lxml",
-                )
-                sf.write_text(str(content))
-            except jinja2.TemplateError as T:
-                logging.exception(
-                    "Failed to render template for {title} - {artist}".format(**songobj)
+                if options.debug:
+                    dumpfile = (
+                        options.output
+                        / "debug"
+                        / songobj.filename.with_suffix(".yml").name
+                    )
+                    dumpfile.write_text(
+                        yaml.safe_dump(with_content(songobj, **parse_opts))
+                    )
+                sf = options.output / "songs" / songobj.filename.name
+                # the page depends on its own songsheet and on the links to its
+                # neighbours, so inserting a song re-renders the songs either side.
+                page_inputs = digest(
+                    book_inputs,
+                    file_digest(songobj.source),
+                    songobj.id,
+                    str(songobj._prev),
+                    str(songobj._next),
                 )
-                logging.error("Context: {chords!r}".format(**songobj))
-                failures.append((songobj, T))
+                if manifest.is_current(sf, page_inputs):
+                    logging.debug(f"{sf} is up to date")
+                    continue
+                # written alongside and moved into place once complete, so a
+                # failure does not leave a partial page over the last good one
+                tmp = sf.with_name(f".{sf.name}.{os.getpid()}.tmp")
+                with profiler.song(songobj.source.name, "render"):
+                    try:
+                        # stream straight to disk, rather than building the whole page.
+                        # When streaming songs too, the content is dropped after this.
+                        st.stream(
+                            song=with_content(songobj, **parse_opts), **context
+                        ).dump(str(tmp), encoding="utf-8")
+                        if options.tidy:
+                            tidy_html(tmp, xhtml=options.layout == "epub")
+                        os.replace(tmp, sf)
+                        manifest.record(sf, page_inputs)
+                    except jinja2.TemplateError as T:
+                        logging.exception(
+                            f"Failed to render template for {songobj.title} - "
+                            f"{songobj.artist}"
+                        )
+                        logging.error(f"Context: {songobj.chords!r}")
+                        failures.append((songobj, T))
+                    finally:
+                        tmp.unlink(missing_ok=True)
         for f, err in failures:
-            print("{title} - {artist} -> {filename}".format(**f), err.__class__, err)
+            print(f"{f.title} - {f.artist} -> {f.filename}", err.__class__, err)
 
     # other EPUB structures
     template_maps = {}
@@ -825,12 +1232,33 @@ def main():  # noqa: C901
     if options.format != "onepage" and not options.no_index:
         template_maps["index.html"] = "index.html.j2"
 
+    # these all depend on the list of songs, but not their content
+    listing_inputs = digest(
+        book_inputs,
+        str(context.get("cover")),
+        json.dumps(
+            [[s.id, s.title, s.artist, s.filename.name] for s in context["songs"]],
+            default=str,
+        ),
+    )
+
     if len(template_maps):
-        for fpath, ftemplate in Bar("Other Templates: ".ljust(20)).iter(
-            template_maps.items()
-        ):
-            t = env.get_template(ftemplate)
-            (options.output / fpath).write_text(t.render(context))
+        with profiler.stage("template_maps"):
+            for fpath, ftemplate in Bar("Other Templates: ".ljust(20)).iter(
+                template_maps.items()
+            ):
+                target = options.output / fpath
+                if manifest.is_current(target, listing_inputs):
+                    continue
+                t = env.get_template(ftemplate)
+                target.write_text(t.render(context))
+                manifest.record(target, listing_inputs)
+
+    manifest.save()
+
+    if options.profile:
+        profiler.save(options.profile)
+        print(f"Profile written to {options.profile}")
 
 
 if __name__ == "__main__":
@@ -3,16 +3,42 @@
 """Convert a PDF book from an HTML songbook."""
 
 import argparse
+import os
 import re
 import sys
+import tempfile
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import cache
+from itertools import groupby
 from pathlib import Path
 
+import weasyprint  # type: ignore
 from bs4 import BeautifulSoup as bs
 from bs4.element import Tag
 from progress.bar import Bar  # type: ignore[import-untyped]
 from weasyprint import CSS, HTML  # type: ignore
 from weasyprint.text.fonts import FontConfiguration  # type: ignore
 
+from ukebook_md.cache import (
+    CACHE_VERSION,
+    DEFAULT_PDF_CACHE_SIZE,
+    PdfCache,
+    default_cache_dir,
+    digest,
+)
+from ukebook_md.manifest import file_digest
+from ukebook_md.pdfassets import CachingFetcher, StylesheetCache
+from ukebook_md.profiling import SLOWEST_SONGS, Profiler, timed
+
+try:
+    from ukebook_md import pdfmerge
+except ImportError:
+    # optional, see collate_parts
+    pdfmerge = None  # type: ignore[assignment]
+
 
 def parse_cmdline(argv):
     """Process commandline options and arguments."""
@@ -36,6 +62,71 @@ def parse_cmdline(argv):
         type=Path,
         help="User stylesheets to apply, must be in the 'css' subdir of the book",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes used to render songs. "
+        "0 means one per CPU core (default: 1, no worker pool). "
+        "More than one needs pypdf",
+    )
+    parser.add_argument(
+        "--volume-size",
+        type=int,
+        metavar="N",
+        help="split the book into volumes of up to N songs, keeping songs with "
+        "the same initial together (OUTPUT_A-F.pdf etc). Needs pypdf",
+    )
+    cachegrp = parser.add_argument_group(
+        "Caching", "Persistent caches used to speed up repeated builds"
+    )
+    cachegrp.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=default_cache_dir(),
+        help="where to store cached data (default: %(default)s)",
+    )
+    cachegrp.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_PDF_CACHE_SIZE // (1024 * 1024),
+        help="maximum size of the rendered song cache in MB (default: %(default)s)",
+    )
+    cachegrp.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Keep rendered songs in the cache, and reuse them when they have not "
+        "changed. Songs are then rendered separately and merged, which needs pypdf",
+    )
+    cachegrp.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Do not use cached results, render every song. The cache is used "
+        "by default with --jobs or --volume-size",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="FILE",
+        help="record the time taken by each stage, and by each song, in FILE (JSON)",
+    )
+    parser.add_argument(
+        "--profile-songs",
+        type=int,
+        default=SLOWEST_SONGS,
+        metavar="N",
+        help="number of slowest songs to include in the profile (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        default=False,
+        help="report peak and retained memory, and the top allocation sites, "
+        "for each stage (slow). Included in the --profile report",
+    )
 
     opts = parser.parse_args(argv)
 
@@ -53,6 +144,9 @@ def parse_cmdline(argv):
     if not opts.stylesheets:
         opts.stylesheets = [Path("portrait")]
 
+    if opts.jobs < 1:
+        opts.jobs = os.cpu_count() or 1
+
     return opts
 
 
@@ -81,52 +175,410 @@ def parse_song(page: Path) -> str:
         return str(linksoup)
 
 
-def collate(options: argparse.Namespace, fontcfg: FontConfiguration):
-    """Convert a directory of HTML pages to a PDF document."""
+def collate(
+    options: argparse.Namespace,
+    fontcfg: FontConfiguration,
+    profiler: Profiler | None = None,
+):
+    """Convert a directory of HTML pages to a PDF document.
+
+    Args:
+        options(argparse.Namespace): commandline options
+        fontcfg(FontConfiguration): fonts shared between documents
+        profiler(Profiler): records time taken by each stage and song
+    """
+    if profiler is None:
+        profiler = Profiler("pdfbook")
     doclist = []
 
     if options.stylesheets:
         print(options.stylesheets)
-        css = [
-            CSS(options.inputdir / "css" / f.with_suffix(".css").name)
+        cssfiles = [
+            options.inputdir / "css" / f.with_suffix(".css").name
             for f in options.stylesheets
-            if options.stylesheets
         ]
     else:
-        css = []
+        cssfiles = []
+
+    # songs are only rendered separately and merged when asked to, one
+    # document is quicker otherwise
+    if options.jobs > 1 or options.volume_size or options.cache:
+        # rendering documents separately needs pypdf to merge them
+        if pdfmerge is None:
+            print(
+                "Rendering songs in parallel, in volumes or from the cache "
+                "needs pypdf (pip install pypdf)"
+            )
+            sys.exit(1)
+        pdfcache = None
+        if not options.no_cache:
+            pdfcache = PdfCache(
+                options.cache_dir / "pdf", max_size=options.cache_size * 1024 * 1024
+            )
+        collate_parts(options, cssfiles, profiler, pdfcache)
+        return
+
+    sheets = stylesheet_cache()
+    css = sheets.get_all(cssfiles)
 
     # handle a cover page if there is one
     if (options.inputdir / "cover.html").exists():
         print("Parsing cover page")
-        cover = parse_cover(options.inputdir / "cover.html")
-        doclist.append(
-            HTML(string=cover, base_url="").render(stylesheets=css, font_config=fontcfg)
-        )
+        with profiler.stage("cover"):
+            cover = parse_cover(options.inputdir / "cover.html")
+            doclist.append(render_document(cover, "", css, fontcfg))
 
     # the index page will be a string as I need to correct the links
     print("Rendering index")
-    index = process_links(options.inputdir / "index.html")
+    with profiler.stage("index"):
+        index = process_links(options.inputdir / "index.html")
 
-    doclist.append(HTML(string=index).render(stylesheets=css, font_config=fontcfg))
+        doclist.append(render_document(index, None, css, fontcfg))
 
     pages = sorted(options.inputdir.glob("songs/*.html"))
 
-    for pg in Bar("Processing HTML").iter(pages):
-        localstyle = options.inputdir / "css" / pg.with_suffix(".css").name
-        stylesheets = css + [CSS(localstyle)] if localstyle.exists() else css
+    with profiler.stage("render_songs"):
+        for pg in Bar("Processing HTML").iter(pages):
+            with profiler.song(pg.name, "render"):
+                localstyle = options.inputdir / "css" / pg.with_suffix(".css").name
+                stylesheets = (
+                    css + [sheets.get(localstyle)] if localstyle.exists() else css
+                )
 
-        song = HTML(string=parse_song(pg), base_url=pg).render(
-            stylesheets=stylesheets, font_config=fontcfg
-        )
-        doclist.append(song)
+                song = render_document(parse_song(pg), str(pg), stylesheets, fontcfg)
+            doclist.append(song)
 
     print("collating pages")
 
-    all_pages = [page for d in doclist for page in d.pages]
+    with profiler.stage("collate"):
+        all_pages = [page for d in doclist for page in d.pages]
+
+        print(f"writing PDF to {options.output}")
+
+        doclist[0].copy(all_pages).write_pdf(options.output, optimize_images=True)
+
 
-    print(f"writing PDF to {options.output}")
+@cache
+def font_config() -> FontConfiguration:
+    """Return the font configuration for this (worker) process."""
+    return FontConfiguration()
 
-    doclist[0].copy(all_pages).write_pdf(options.output, optimize_images=True)
+
+@cache
+def url_fetcher() -> CachingFetcher:
+    """Return the URL fetcher for this (worker) process."""
+    return CachingFetcher()
+
+
+@cache
+def image_cache() -> dict:
+    """Return the images loaded by this (worker) process.
+
+    WeasyPrint keeps the images a document uses in a dictionary keyed on
+    their URL. Sharing one between documents means each image is parsed
+    once, and is the same object (so embedded once) in every document.
+    """
+    return {}
+
+
+@cache
+def stylesheet_cache() -> StylesheetCache:
+    """Return the stylesheets parsed by this (worker) process."""
+    return StylesheetCache(url_fetcher=url_fetcher())
+
+
+def render_document(
+    html: str,
+    base_url: str | None,
+    stylesheets: list[CSS],
+    fontcfg: FontConfiguration,
+) -> weasyprint.Document:
+    """Render HTML, sharing files, images and fonts with other documents.
+
+    Args:
+        html(str): document content
+        base_url(str): base for relative URLs in the document
+        stylesheets(list): parsed stylesheets, see stylesheet_cache
+        fontcfg(FontConfiguration): fonts shared between documents
+    """
+    return HTML(string=html, base_url=base_url, url_fetcher=url_fetcher()).render(
+        stylesheets=stylesheets, font_config=fontcfg, cache=image_cache()
+    )
+
+
+def render_part(
+    html: str, base_url: str | None, stylesheets: list[Path], output: Path
+) -> Path:
+    """Render one document of a book to a PDF file of its own.
+
+    Module-level, so it can be run in worker processes, which cannot share
+    WeasyPrint documents or stylesheets with the parent. Each process parses
+    a stylesheet or image once, however many documents use it.
+
+    Args:
+        html(str): document content, see add_placeholders
+        base_url(str): base for relative URLs in the document
+        stylesheets(list): CSS files to apply
+        output(Path): PDF file to write
+    """
+    render_document(
+        html, base_url, stylesheet_cache().get_all(stylesheets), font_config()
+    ).write_pdf(output, optimize_images=True)
+    return output
+
+
+def add_placeholders(html: str) -> tuple[str, set[str]]:
+    """Add placeholder anchors for internal links to other documents.
+
+    WeasyPrint drops links to anchors it cannot find, so documents rendered
+    separately need a stand-in for every link target defined elsewhere in
+    the book. These are positioned out of the flow, so do not change the
+    layout, and are replaced by the real targets when parts are merged
+    (see pdfmerge).
+
+    Returns:
+        tuple: updated HTML and the names of the placeholders added
+    """
+    soup = bs(html, features="lxml")
+    ids = {str(tag["id"]) for tag in soup.find_all(id=True)}
+    hrefs = [str(a["href"]) for a in soup.find_all("a", href=True)]
+    targets = {
+        href[1:] for href in hrefs if href.startswith("#") and len(href) > 1
+    } - ids
+    if not targets:
+        return html, targets
+    body = soup.body or soup
+    for name in sorted(targets, reverse=True):
+        body.insert(0, soup.new_tag("span", id=name, style="position: absolute"))
+    return str(soup), targets
+
+
+def part_key(html: str, base_url: str | None, stylesheets: list[Path]) -> str:
+    """Generate a cache key for a document rendered on its own.
+
+    Covers the document, its stylesheets, local files it refers to (images,
+    by file:// URL, see parse_song) and the WeasyPrint version, which
+    between them determine the layout.
+    """
+    images = sorted(set(re.findall(r'src="file://([^"]+)"', html)))
+    return digest(
+        str(CACHE_VERSION),
+        weasyprint.__version__,
+        html,
+        base_url or "",
+        *[file_digest(Path(s)) for s in stylesheets],
+        *[f"{i}:{file_digest(Path(i))}" for i in images if Path(i).is_file()],
+    )
+
+
+def split_volumes(pages: list[Path], size: int) -> list[tuple[str, list[Path]]]:
+    """Split songs into volumes, keeping songs with the same initial together.
+
+    Songs are in order of initial (ignoring case), then filename, so each
+    volume covers a range of letters.
+    A volume only has more than `size` songs if that many share an initial.
+
+    Returns:
+        list: label (range of initials, e.g. "A-F") and songs of each volume
+    """
+
+    def initial(page: Path) -> str:
+        return page.name[:1].upper()
+
+    volumes: list[tuple[list[str], list[Path]]] = []
+    # filenames sort case-sensitively (Z before a), but volumes are by initial
+    for letter, group in groupby(sorted(pages, key=initial), key=initial):
+        songs = list(group)
+        if not volumes or len(volumes[-1][1]) + len(songs) > size:
+            volumes.append(([], []))
+        volumes[-1][0].append(letter)
+        volumes[-1][1].extend(songs)
+    return [
+        (letters[0] if len(letters) == 1 else f"{letters[0]}-{letters[-1]}", songs)
+        for letters, songs in volumes
+    ]
+
+
+def volume_index(index: str, songs: list[Path]) -> str:
+    """Remove index entries for songs that are not in a volume.
+
+    Args:
+        index(str): index page, with links rewritten by process_links
+        songs(list): songsheets in the volume
+    """
+    titles = set()
+    for pg in songs:
+        titles.update(re.findall(r'id="(title_[^"]+)"', pg.read_text()))
+    idxsoup = bs(index, features="lxml")
+    for a in idxsoup.find_all("a", class_="indexlink"):
+        if str(a["href"]).lstrip("#") not in titles:
+            br = a.find_next_sibling()
+            if isinstance(br, Tag) and br.name == "br":
+                br.decompose()
+            a.decompose()
+    return str(idxsoup)
+
+
+def book_documents(
+    options: argparse.Namespace,
+    cssfiles: list[Path],
+    songs: list[Path],
+    volume: bool = False,
+) -> Iterator[tuple[str, str, str | None, list[Path]]]:
+    """Generate the documents that make up a book, in order.
+
+    Each is only read and processed when needed, so they do not all have to
+    be held in memory at once.
+
+    Args:
+        options(argparse.Namespace): commandline options
+        cssfiles(list): book stylesheets
+        songs(list): songsheets to include
+        volume(bool): only index the songs included
+
+    Yields:
+        tuple: name, content, base URL and stylesheets of each document
+    """
+    if (options.inputdir / "cover.html").exists():
+        print("Parsing cover page")
+        yield "cover.html", parse_cover(options.inputdir / "cover.html"), "", cssfiles
+
+    index = process_links(options.inputdir / "index.html")
+    if volume:
+        index = volume_index(index, songs)
+    yield "index.html", index, None, cssfiles
+
+    for pg in songs:
+        localstyle = options.inputdir / "css" / pg.with_suffix(".css").name
+        stylesheets = cssfiles + [localstyle] if localstyle.exists() else cssfiles
+        yield pg.name, parse_song(pg), str(pg), stylesheets
+
+
+def render_parts(
+    documents: Iterable[tuple[str, str, str | None, list[Path]]],
+    workdir: Path,
+    jobs: int = 1,
+    pdfcache: PdfCache | None = None,
+    profiler: Profiler | None = None,
+) -> list[tuple[Path, set[str]]]:
+    """Render documents to a PDF file each, ready for pdfmerge.
+
+    Documents are reused from the cache if nothing that affects their layout
+    has changed. Worker processes are only given a few documents at a time,
+    so memory use does not grow with the size of the book.
+
+    Args:
+        documents(Iterable): name, content, base URL and stylesheets of each
+                             document, see book_documents
+        workdir(Path): where to write rendered documents
+        jobs(int): number of worker processes, 1 renders in this process
+        pdfcache(PdfCache): previously rendered documents
+        profiler(Profiler): records time taken by each document
+
+    Returns:
+        list: PDF file and placeholder anchors of each document, in order
+    """
+    parts = []
+    # name, cache key and pending result of documents being rendered
+    rendering: deque[tuple[str, str | None, Future]] = deque()
+    cached = 0
+
+    def finished(name: str, key: str | None, result: tuple):
+        output, wall, cpu = result
+        if profiler is not None:
+            profiler.record_song(name, "render", wall, cpu)
+        if pdfcache is not None and key is not None:
+            pdfcache.put(key, output)
+
+    with (
+        ProcessPoolExecutor(max_workers=jobs, initializer=font_config)
+        if jobs > 1
+        else nullcontext()
+    ) as pool:
+        for number, (name, html, base_url, stylesheets) in enumerate(documents):
+            html, placeholders = add_placeholders(html)
+            key = None
+            if pdfcache is not None:
+                key = part_key(html, base_url, stylesheets)
+                output = pdfcache.get(key)
+                if output is not None:
+                    parts.append((output, placeholders))
+                    cached += 1
+                    continue
+
+            output = workdir / f"{number:05d}.pdf"
+            parts.append((output, placeholders))
+            job = (html, base_url, stylesheets, output)
+            if pool is None:
+                finished(name, key, timed(render_part, *job))
+                continue
+            rendering.append((name, key, pool.submit(timed, render_part, *job)))
+            # enough to keep every worker busy
+            if len(rendering) >= jobs * 2:
+                name, key, future = rendering.popleft()
+                finished(name, key, future.result())
+
+        while rendering:
+            name, key, future = rendering.popleft()
+            finished(name, key, future.result())
+
+    if pdfcache is not None:
+        print(f"{cached} documents unchanged, using cache")
+    return parts
+
+
+def collate_parts(
+    options: argparse.Namespace,
+    cssfiles: list[Path],
+    profiler: Profiler,
+    pdfcache: PdfCache | None = None,
+):
+    """Render each document of a book to its own PDF, then merge them.
+
+    Produces the same pages, links and destinations as rendering them all in
+    one process, but only holds one document's layout at a time (per worker),
+    so memory use is roughly constant with book size. Songs are still sorted
+    by filename.
+
+    With options.volume_size, the book is split into volumes, each with its
+    own index, written next to options.output (e.g. BOOK_A-F.pdf).
+
+    Args:
+        options(argparse.Namespace): commandline options
+        cssfiles(list): book stylesheets
+        profiler(Profiler): records time taken by each stage and song
+        pdfcache(PdfCache): previously rendered documents
+    """
+    pages = sorted(options.inputdir.glob("songs/*.html"))
+    if options.volume_size:
+        volumes = split_volumes(pages, options.volume_size)
+    else:
+        volumes = [("", pages)]
+
+    for label, songs in volumes:
+        output = options.output
+        if label:
+            output = output.with_name(f"{output.stem}_{label}{output.suffix}")
+
+        with tempfile.TemporaryDirectory(prefix="ukebook-pdf-") as td:
+            with profiler.stage("render_songs"):
+                documents = book_documents(options, cssfiles, songs, volume=bool(label))
+                # songs, plus the index and cover (if any)
+                count = len(songs) + 1 + (options.inputdir / "cover.html").exists()
+                parts = render_parts(
+                    Bar("Processing HTML", max=count).iter(documents),
+                    Path(td),
+                    jobs=options.jobs,
+                    pdfcache=pdfcache,
+                    profiler=profiler,
+                )
+
+            print(f"collating pages, writing PDF to {output}")
+            with profiler.stage("collate"):
+                pdfmerge.merge(parts, output)
+
+    if pdfcache is not None:
+        pdfcache.prune()
 
 
 def process_links(index: Path) -> str:
@@ -134,10 +586,10 @@ def process_links(index: Path) -> str:
     with index.open() as idx:
         idxsoup = bs(idx, features="lxml")
         for a in idxsoup.findAll("a"):
-            if re.match(r"title_\d{3}", a["href"]):
+            if re.match(r"#?title_", a["href"]):
                 continue
             else:
-                linkid = a["id"].split("_")[1]
+                linkid = a["id"].split("_", 1)[1]
                 a["href"] = f"#title_{linkid}"
         for i in idxsoup.findAll("img"):
             i["src"] = f"file://{index.parent.resolve()}/{i['src']}"
@@ -147,8 +599,13 @@ def process_links(index: Path) -> str:
 def main():
     """Run all the pretty things."""
     opts = parse_cmdline(sys.argv[1:])
+    profiler = Profiler("pdfbook", slowest=opts.profile_songs, memory=opts.memory)
+
+    collate(opts, FontConfiguration(), profiler)
 
-    collate(opts, FontConfiguration())
+    if opts.profile:
+        profiler.save(opts.profile)
+        print(f"Profile written to {opts.profile}")
 
 
 def parse_cover(page: Path, link_target="#index00") -> str:
@@ -15,10 +15,14 @@ from pathlib import Path
 import jinja2
 import yaml
 from bs4 import BeautifulSoup as bs
-from weasyprint import CSS, HTML  # type: ignore[import-untyped]
+from weasyprint import HTML  # type: ignore[import-untyped]
 from weasyprint.text.fonts import FontConfiguration  # type: ignore[import-untyped]
 
+from ukebook_md.cache import default_cache_dir
 from ukebook_md.genbook import parse_song, safe_name
+from ukebook_md.pdfassets import CachingFetcher, StylesheetCache
+from ukebook_md.profiling import SLOWEST_SONGS, Profiler
+from ukebook_md.templating import get_environment
 
 """
 Separates out the rendering and PDF conversion for an individual
@@ -133,6 +137,38 @@ def parse_commandline(argv: list) -> argparse.Namespace:
         default=False,
         help="Clean up nasty swearing",
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=default_cache_dir(),
+        help="where to store compiled templates (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Do not keep compiled templates",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="FILE",
+        help="record the time taken by each stage, and by each song, in FILE (JSON)",
+    )
+    parser.add_argument(
+        "--profile-songs",
+        type=int,
+        default=SLOWEST_SONGS,
+        metavar="N",
+        help="number of slowest songs to include in the profile (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        default=False,
+        help="report peak and retained memory, and the top allocation sites, "
+        "for each stage (slow). Included in the --profile report",
+    )
 
     opts = parser.parse_args(argv)
 
@@ -170,6 +206,7 @@ def main():
     # generate context for songsheet
     # simplistic as this is for karauke only
     opts = parse_commandline(sys.argv[1:])
+    profiler = Profiler("pdfsong", slowest=opts.profile_songs, memory=opts.memory)
     ctx = {
         "book_css": opts.stylesheet.name,
         "css_path": opts.stylesheet.parent,
@@ -180,20 +217,27 @@ def main():
         "songbook": "none",
     }
 
+    # templates in the current directory override the built-in ones
+    env = get_environment(
+        Path("templates"),
+        cachedir=None if opts.no_cache else opts.cache_dir / "templates",
+        lstrip_blocks=True,
+        trim_blocks=True,
+    )
+    env.filters["safe_name"] = safe_name
+    st = env.get_template("song.html.j2")
+    # shared by all songs, so each stylesheet, file and image is loaded once
+    fetcher = CachingFetcher()
+    images: dict = {}
+    sheets = StylesheetCache(url_fetcher=fetcher)
+
     for song in opts.inputfile:
-        ctx["song"] = parse_song(song, family_friendly=opts.family_friendly)
+        with profiler.stage("parse_song"), profiler.song(song.name, "parse"):
+            ctx["song"] = parse_song(song, family_friendly=opts.family_friendly)
         ctx["image_dir"] = opts.image_dir
         # create tempdir for HTML
         # render HTML to PDF using the appropriate stylesheet
         # remove tempdir
-        env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader("templates"),
-            lstrip_blocks=True,
-            trim_blocks=True,
-        )
-        env.filters["safe_name"] = safe_name
-
-        st = env.get_template("song.html.j2")
         # need to fix the title/artist parsing for some songs
         # (Those with '-' in the title)
         if opts.debug:
@@ -212,12 +256,13 @@ def main():
 
         fontcfg = FontConfiguration()
         logger.debug(f"using {opts.stylesheet} as stylesheet")
-        css = [CSS(opts.stylesheet.resolve())]
+        css = [sheets.get(opts.stylesheet)]
 
-        htmlfile = tmppath / ctx["song"]["filename"]
+        htmlfile = tmppath / ctx["song"].filename
 
         try:
-            content = bs(st.render(ctx), features="lxml")
+            with profiler.stage("render_html"), profiler.song(song.name, "render"):
+                content = bs(st.render(ctx), features="lxml")
             # save an HTML version. Is this really needed?
             htmlfile.write_text(str(content))
 
@@ -228,16 +273,17 @@ def main():
             content.find("a", {"class": "right"}).decompose()
 
             # create a PDF doc from the HTML
-            doc = HTML(string=str(content)).render(stylesheets=css, font_config=fontcfg)
+            with profiler.stage("render_pdf"), profiler.song(song.name, "pdf"):
+                doc = HTML(string=str(content), url_fetcher=fetcher).render(
+                    stylesheets=css, font_config=fontcfg, cache=images
+                )
 
             opts.output.mkdir(parents=True, exist_ok=True)
 
-            print(
-                f"filename: {ctx['song']['filename']}, {type(ctx['song']['filename'])}"
-            )
+            print(f"filename: {ctx['song'].filename}, {type(ctx['song'].filename)}")
             print(f"destdir: {opts.output}")
 
-            pdffile = opts.output / ctx["song"]["filename"].with_suffix(".pdf").name
+            pdffile = opts.output / ctx["song"].filename.with_suffix(".pdf").name
 
             if pdffile.exists() and not opts.force:
                 logger.info(f"backing up existing file {pdffile}")
@@ -250,18 +296,23 @@ def main():
 
             print(f"writing PDF to {pdffile}")
 
-            doc.write_pdf(pdffile)
+            with profiler.stage("write_pdf"), profiler.song(song.name, "write"):
+                doc.write_pdf(pdffile)
         except jinja2.TemplateError:
             logger.exception(
-                f"Failed to render template for {ctx['song']['title']} - "
-                f"{ctx['song']['artist']}"
+                f"Failed to render template for {ctx['song'].title} - "
+                f"{ctx['song'].artist}"
             )
             raise
         if opts.debug:
-            shutil.copy(os.path.join(td.name, ctx["song"]["filename"]), ".")
+            shutil.copy(os.path.join(td.name, ctx["song"].filename), ".")
 
         # parse the songsheet from UDN input to get a context
 
+    if opts.profile:
+        profiler.save(opts.profile)
+        logger.info(f"Profile written to {opts.profile}")
+
 
 if __name__ == "__main__":
     main()
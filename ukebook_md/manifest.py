@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Build manifests, used to support incremental builds.
+
+A manifest records, for each output file, a digest of the inputs it was built
+from. On the next build, files whose inputs have not changed can be skipped.
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import jinja2
+
+from ukebook_md.cache import digest
+
+MANIFEST_VERSION = 1
+
+
+def file_digest(path: Path) -> str:
+    """Generate a digest of a file's content."""
+    return digest(Path(path).read_bytes())
+
+
+def template_digest(env: jinja2.Environment) -> str:
+    """Generate a digest covering every template available to an environment."""
+    if env.loader is None:
+        return digest("")
+    return digest(*[
+        env.loader.get_source(env, name)[0] for name in sorted(env.list_templates())
+    ])
+
+
+def copy_if_changed(src: str, dst: str) -> str:
+    """Copy a file unless the destination looks identical.
+
+    Uses the same quick check as rsync (size and modification time), which is
+    reliable here because copies are made with shutil.copy2, preserving mtimes.
+    Suitable for use as a copy_function for shutil.copytree.
+    """
+    try:
+        s, d = os.stat(src), os.stat(dst)
+        if s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime):
+            return dst
+    except OSError:
+        pass
+    return shutil.copy2(src, dst)
+
+
+class BuildManifest:
+    """Record of the inputs each output file in a book was built from."""
+
+    filename = ".manifest.json"
+
+    def __init__(self, outdir: Path, refresh: bool = True):
+        """Load the manifest from a previous build, if there is one.
+
+        Args:
+            outdir(Path): top-level output directory for the book
+            refresh(bool): if False, ignore any previous manifest, so
+                           every file is considered out of date
+        """
+        self.outdir = Path(outdir)
+        self.path = self.outdir / self.filename
+        self.previous: dict[str, str] = {}
+        self.current: dict[str, str] = {}
+
+        if refresh and self.path.exists():
+            try:
+                data = json.loads(self.path.read_text())
+                if data.get("version") == MANIFEST_VERSION:
+                    self.previous = data["files"]
+            except (OSError, ValueError, KeyError):
+                # a damaged manifest just means a full rebuild
+                self.previous = {}
+
+    def _key(self, target: Path) -> str:
+        return os.path.relpath(target, self.outdir)
+
+    def is_current(self, target: Path, inputs: str) -> bool:
+        """Check whether a target was last built from the same inputs.
+
+        Args:
+            target(Path): output file
+            inputs(str): digest of everything the target is built from
+        """
+        key = self._key(target)
+        if self.previous.get(key) == inputs and Path(target).exists():
+            self.current[key] = inputs
+            return True
+        return False
+
+    def record(self, target: Path, inputs: str):
+        """Record the inputs a target has just been built from."""
+        self.current[self._key(target)] = inputs
+
+    def save(self):
+        """Write the manifest to the output directory.
+
+        Entries from the previous build are kept for files that still exist,
+        but were not considered this time (with --no-html, for example).
+        """
+        files = {
+            k: v
+            for k, v in self.previous.items()
+            if (self.outdir / k).exists() and k not in self.current
+        }
+        files.update(self.current)
+        self.path.write_text(
+            json.dumps(
+                {"version": MANIFEST_VERSION, "files": files}, indent=1, sort_keys=True
+            )
+        )
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Resources shared between documents rendered to PDF in one run.
+
+A book is rendered as hundreds of WeasyPrint documents, which mostly use the
+same stylesheets and images (chord diagrams, logos). Each distinct stylesheet
+is parsed once and local files are read once, and the results are shared by
+every document that uses them.
+"""
+
+from pathlib import Path
+
+from weasyprint import CSS  # type: ignore
+
+from ukebook_md.cache import digest
+
+try:
+    from weasyprint.urls import URLFetcher, URLFetcherResponse  # type: ignore
+except ImportError:
+    # older WeasyPrint, where URL fetchers are functions returning a dict
+    from weasyprint.urls import default_url_fetcher  # type: ignore
+
+    URLFetcher = None
+
+
+class CachingFetcher(URLFetcher or object):  # type: ignore[misc]
+    """URL fetcher keeping the content of local files in memory.
+
+    Files do not change while a book is rendered, so each file:// URL is read
+    once, however many documents refer to it. Other URLs are fetched as
+    WeasyPrint normally would. Works as a fetcher object (WeasyPrint's
+    URLFetcher) or as a function, depending on the WeasyPrint version.
+    """
+
+    def __init__(self, **kwargs):
+        """Create a fetcher with nothing cached.
+
+        Kwargs:
+            options for WeasyPrint's URLFetcher (timeout etc), if it has one
+        """
+        super().__init__(**kwargs)
+        # URL => content and details of the response
+        self.assets: dict[str, dict] = {}
+        self.hits = 0
+
+    def cached(self, url: str) -> dict | None:
+        """Return the stored response for a URL, if there is one."""
+        entry = self.assets.get(url.split("?")[0])
+        if entry is not None:
+            self.hits += 1
+        return entry
+
+    def store(self, url: str, entry: dict) -> dict:
+        """Keep a response for a local file, returning it."""
+        if url.startswith("file:"):
+            self.assets[url.split("?")[0]] = entry
+        return entry
+
+    if URLFetcher is not None:
+
+        def fetch(self, url: str, headers: dict | None = None):
+            """Fetch a URL, from memory if it has been read already."""
+            entry = self.cached(url)
+            if entry is None:
+                response = super().fetch(url, headers)
+                try:
+                    body = response.read()
+                finally:
+                    response.close()
+                entry = self.store(
+                    url,
+                    {
+                        "url": response.url,
+                        "body": body,
+                        "headers": response.headers,
+                        "status": response.status,
+                    },
+                )
+            return URLFetcherResponse(**entry)
+
+    else:
+
+        def __call__(self, url: str) -> dict:
+            """Fetch a URL, from memory if it has been read already."""
+            entry = self.cached(url)
+            if entry is None:
+                entry = default_url_fetcher(url)
+                if "file_obj" in entry:
+                    file_obj = entry.pop("file_obj")
+                    try:
+                        entry["string"] = file_obj.read()
+                    finally:
+                        file_obj.close()
+                entry = self.store(url, entry)
+            return dict(entry)
+
+
+class StylesheetCache:
+    """Parsed stylesheets, shared between documents.
+
+    Stylesheets are identified by their content, so byte-identical files
+    (such as the per-song stylesheets genbook generates for font sizes) are
+    parsed once. Relative URLs in a stylesheet depend on where it is, so
+    identical files in different directories are parsed separately.
+    """
+
+    def __init__(self, url_fetcher=None):
+        """Create an empty cache.
+
+        Args:
+            url_fetcher: used for @import rules, WeasyPrint's default if None
+        """
+        self.url_fetcher = url_fetcher
+        # (content digest, directory) => parsed stylesheet
+        self.parsed: dict[tuple[str, str], CSS] = {}
+        self.hits = 0
+
+    def __len__(self) -> int:
+        """Return the number of distinct stylesheets parsed."""
+        return len(self.parsed)
+
+    def get(self, path: Path) -> CSS:
+        """Return the parsed stylesheet in a file.
+
+        Args:
+            path(Path): CSS file
+        """
+        path = Path(path).resolve()
+        content = path.read_bytes()
+        key = (digest(content), str(path.parent))
+        if key in self.parsed:
+            self.hits += 1
+        else:
+            self.parsed[key] = CSS(
+                string=content.decode(),
+                base_url=str(path),
+                url_fetcher=self.url_fetcher,
+            )
+        return self.parsed[key]
+
+    def get_all(self, paths: list[Path]) -> list[CSS]:
+        """Return parsed stylesheets for a list of files, in order."""
+        return [self.get(p) for p in paths]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Merge separately rendered PDFs into a single book.
+
+WeasyPrint resolves internal links (#title_..., #index00) when a document is
+written, and drops any whose target is not in the same document. Parts of a
+book rendered on their own therefore carry placeholder anchors for targets
+defined in other parts (see makepdf.add_placeholders). When merging, every
+named destination points at the first part that really defines it, exactly
+as WeasyPrint does for a single document, and links to targets that are not
+defined anywhere are dropped, as WeasyPrint would have done. Images (and
+other resources) used by several parts are stored once in the merged file.
+
+Needs pypdf, which is an optional dependency (pip install ukebook-md[pdfmerge])
+"""
+
+from pathlib import Path
+from typing import cast
+
+from pypdf import PdfReader, PdfWriter  # type: ignore
+from pypdf.generic import (  # type: ignore
+    ArrayObject,
+    DictionaryObject,
+    NameObject,
+    TextStringObject,
+)
+
+
+def named_link(annot: DictionaryObject) -> str | None:
+    """Return the named destination a link annotation points to, if any."""
+    if annot.get("/Subtype") != "/Link":
+        return None
+    dest = annot.get("/Dest")
+    if dest is None:
+        dest = (annot.get("/A") or {}).get("/D")
+    return str(dest) if isinstance(dest, str) else None
+
+
+def merge(parts: list[tuple[Path, set[str]]], output: Path):
+    """Merge PDFs into one, in order, keeping internal links working.
+
+    Document metadata is taken from the first part.
+
+    Args:
+        parts(list): PDF files, each with the names of the placeholder
+                     anchors it was rendered with
+        output(Path): PDF file to write
+    """
+    writer = PdfWriter()
+    # first real definition of each name => destination in the merged file
+    destinations: dict[str, ArrayObject] = {}
+    # annotations copied to merged pages, with the destination each uses
+    annotations = []
+
+    for number, (part, placeholders) in enumerate(parts):
+        reader = PdfReader(part)
+        if number == 0 and reader.metadata is not None:
+            writer.add_metadata(reader.metadata)
+
+        start = len(writer.pages)
+        # annotations are copied below, pypdf would drop links to
+        # destinations in parts not merged yet
+        writer.append(reader, excluded_fields=["/Annots"])
+
+        for name, dest in reader.named_destinations.items():
+            if name in placeholders or name in destinations:
+                continue
+            pagenum = reader.get_destination_page_number(dest)
+            if pagenum is None:
+                continue
+            page = writer.pages[start + pagenum]
+            destinations[name] = ArrayObject([
+                page.indirect_reference,
+                *dest.dest_array[1:],
+            ])
+
+        for offset, page in enumerate(reader.pages):
+            for annot in page.get("/Annots") or []:
+                annot = annot.get_object()
+                annotations.append((
+                    writer.pages[start + offset],
+                    named_link(annot),
+                    annot.clone(writer).indirect_reference,
+                ))
+
+    for page, target, annot in annotations:
+        if target is not None and target not in destinations:
+            continue
+        if "/Annots" not in page:
+            page[NameObject("/Annots")] = ArrayObject()
+        cast(ArrayObject, page["/Annots"]).append(annot)
+
+    # replaces the destinations pypdf copied, which include placeholders.
+    # Name trees must be sorted
+    names = ArrayObject()
+    for name in sorted(destinations):
+        names.extend([TextStringObject(name), destinations[name]])
+    if "/Names" not in writer.root_object:
+        writer.root_object[NameObject("/Names")] = DictionaryObject()
+    cast(DictionaryObject, writer.root_object["/Names"])[NameObject("/Dests")] = (
+        DictionaryObject({NameObject("/Names"): names})
+    )
+
+    # each part embeds its own copy of images used in several parts,
+    # keep one of each
+    writer.compress_identical_objects()
+    writer.write(output)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Timing and memory instrumentation for songbook builds.
+
+Records wall-clock and CPU time for each stage of a build, and for each
+song, so that reports from different releases can be compared (--profile).
+Optionally, tracks memory allocated by each stage too (--memory).
+"""
+
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from ukebook_md.cache import package_version
+
+PROFILE_VERSION = 1
+
+# default number of slowest songs to include in a report
+SLOWEST_SONGS = 10
+
+# number of allocation sites reported for each stage
+TOP_ALLOCATIONS = 5
+
+# allocations made by the instrumentation itself
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def human_size(size: int) -> str:
+    """Format a size in bytes for display."""
+    if abs(size) < 1024 * 1024:
+        return f"{size / 1024:.1f}kB"
+    return f"{size / (1024 * 1024):.1f}MB"
+
+
+def timed(func: Callable, *args, **kwargs) -> tuple:
+    """Call a function, timing it.
+
+    Module-level, so it can wrap work sent to worker processes, where the
+    time would otherwise be lost.
+
+    Returns:
+        tuple: result, wall-clock time and CPU time (in seconds)
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+class Profiler:
+    """Collects timings for the stages of a build and individual songs.
+
+    Stages and song steps may be entered more than once, times are added up.
+
+    With memory tracking enabled, each stage also records the peak memory
+    allocated while it ran, how much of that was still allocated at the end
+    (retained), and the sites responsible for most of it. This uses
+    tracemalloc, which slows everything down, and only sees allocations in
+    this process (not in worker processes). Stages should not be nested, as
+    each one resets the peak.
+    """
+
+    def __init__(
+        self, command: str, slowest: int = SLOWEST_SONGS, memory: bool = False
+    ):
+        """Start profiling a build.
+
+        Args:
+            command(str): name of the tool being profiled (e.g. htmlbook)
+            slowest(int): number of slowest songs to report
+            memory(bool): track memory allocation per stage
+        """
+        self.command = command
+        self.slowest = slowest
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = datetime.now()
+        self.stages: dict[str, dict] = {}
+        self.songs: dict[str, dict[str, dict]] = {}
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    @staticmethod
+    def _add(entry: dict, wall: float, cpu: float):
+        entry["wall"] = entry.get("wall", 0.0) + wall
+        entry["cpu"] = entry.get("cpu", 0.0) + cpu
+        entry["calls"] = entry.get("calls", 0) + 1
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the build.
+
+        Args:
+            name(str): stage name, e.g. "parse_songsheets"
+        """
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {})
+            self._add(entry, time.perf_counter() - wall, time.process_time() - cpu)
+            if self.memory:
+                self._add_memory(name, entry, before, snapshot)
+
+    def _add_memory(
+        self, name: str, entry: dict, before: int, snapshot: tracemalloc.Snapshot
+    ):
+        current, peak = tracemalloc.get_traced_memory()
+        entry["peak"] = max(entry.get("peak", 0), peak)
+        entry["retained"] = entry.get("retained", 0) + current - before
+
+        # where the memory still held at the end of the stage came from
+        after = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        stats = sorted(
+            after.compare_to(snapshot, "lineno"),
+            key=lambda s: s.size_diff,
+            reverse=True,
+        )
+        entry["allocations"] = [
+            {
+                "site": str(stat.traceback[0]),
+                "size": stat.size_diff,
+                "count": stat.count_diff,
+            }
+            for stat in stats[:TOP_ALLOCATIONS]
+            if stat.size_diff > 0
+        ]
+
+        print(
+            f"{name}: peak memory {human_size(peak)}, "
+            f"retained {human_size(current - before)}"
+        )
+        for site in entry["allocations"]:
+            print(f"    {human_size(site['size']):>9} {site['site']}")
+
+    def record_song(self, song: str, step: str, wall: float, cpu: float):
+        """Record time spent on one step of processing a song.
+
+        Args:
+            song(str): song identifier, normally the songsheet filename
+            step(str): what was being done, e.g. "parse" or "render"
+            wall(float): wall-clock time in seconds
+            cpu(float): CPU time in seconds
+        """
+        self._add(self.songs.setdefault(song, {}).setdefault(step, {}), wall, cpu)
+
+    @contextmanager
+    def song(self, song: str, step: str) -> Iterator[None]:
+        """Time one step of processing a song, see record_song."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.record_song(
+                song, step, time.perf_counter() - wall, time.process_time() - cpu
+            )
+
+    def report(self) -> dict:
+        """Generate a report of the timings collected so far."""
+        totals = []
+        for name, steps in self.songs.items():
+            totals.append({
+                "song": name,
+                "wall": sum(s["wall"] for s in steps.values()),
+                "cpu": sum(s["cpu"] for s in steps.values()),
+                "steps": steps,
+            })
+        totals.sort(key=lambda s: s["wall"], reverse=True)
+
+        return {
+            "version": PROFILE_VERSION,
+            "command": self.command,
+            "argv": sys.argv[1:],
+            "started": self.started.isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "ukebook_md": package_version("ukebook-md"),
+            "total": {
+                "wall": time.perf_counter() - self._wall,
+                "cpu": time.process_time() - self._cpu,
+            },
+            "memory": self.memory,
+            "stages": self.stages,
+            "songs": {"count": len(self.songs), "slowest": totals[: self.slowest]},
+        }
+
+    def save(self, path: Path):
+        """Write the report to a file, as JSON."""
+        Path(path).write_text(json.dumps(self.report(), indent=2) + "\n")
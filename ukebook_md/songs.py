@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Data structures for collections of parsed songs."""
+
+from collections.abc import Iterator
+from pathlib import Path
+
+
+class Song:
+    """A parsed songsheet, with the fields used by templates.
+
+    Derived fields (output filename and links to neighbouring songs) are
+    computed on demand. Links need the SongIndex the song belongs to, which
+    is not pickled, so songs stay cheap to send to worker processes.
+    """
+
+    __slots__ = (
+        "id",
+        "source",
+        "title",
+        "artist",
+        "html",
+        "chords",
+        "meta",
+        "prev_id",
+        "next_id",
+        "_index",
+    )
+
+    def __init__(
+        self,
+        songid: str,
+        source: Path,
+        title: str = "",
+        artist: str = "",
+        html: str | None = None,
+        chords: list[str] | None = None,
+        meta: dict | None = None,
+    ):
+        """Create a song record.
+
+        Args:
+            songid(str): unique identifier
+            source(Path): path to the songsheet
+            title(str): song title
+            artist(str): artist, or other credit, empty if there is none
+            html(str): converted songsheet, None if not (yet) loaded
+            chords(list): chords used, in order of appearance
+            meta(dict): metadata from the songsheet
+        """
+        self.id = songid
+        self.source = source
+        self.title = title
+        self.artist = artist
+        self.html = html
+        self.chords = chords if chords is not None else []
+        self.meta = meta if meta is not None else {}
+        self.prev_id: str | None = None
+        self.next_id: str | None = None
+        self._index: SongIndex | None = None
+
+    def __repr__(self) -> str:
+        return f"<Song {self.id}: {self.title} - {self.artist}>"
+
+    def __getstate__(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__ if k != "_index"}
+
+    def __setstate__(self, state: dict):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self._index = None
+
+    @property
+    def filename(self) -> Path:
+        """Output filename (HTML) for this song."""
+        return self.source.with_suffix(".html")
+
+    @property
+    def _prev(self) -> Path | str:
+        """Relative link to the previous song, or the index."""
+        if self._index is None:
+            return "../index.html"
+        return self._index.link(self.prev_id)
+
+    @property
+    def _next(self) -> Path | str:
+        """Relative link to the next song, or the index."""
+        if self._index is None:
+            return "../index.html"
+        return self._index.link(self.next_id)
+
+    def replace(self, **changes) -> "Song":
+        """Return a copy of this song, with the given fields changed."""
+        song = Song.__new__(Song)
+        for k in self.__slots__:
+            setattr(song, k, changes.get(k, getattr(self, k)))
+        return song
+
+    def as_dict(self) -> dict:
+        """Return a dict representation, for debugging output."""
+        data = {k: getattr(self, k) for k in self.__slots__ if k != "_index"}
+        data["filename"] = self.filename
+        return data
+
+
+class SongIndex:
+    """An ordered collection of songs, with constant-time lookups.
+
+    Songs are kept in the order they are added (i.e. book order) and can be
+    found by ID, title, artist or output filename. Titles and artists are
+    matched case-insensitively and may be shared by several songs.
+
+    Iterating over the index yields songs in book order, so it can be passed
+    straight to templates in place of a list.
+    """
+
+    def __init__(self, songs=()):
+        """Create an index, optionally populated with songs."""
+        self._songs: list[Song] = []
+        self._position: dict[str, int] = {}
+        self._by_title: dict[str, list[Song]] = {}
+        self._by_artist: dict[str, list[Song]] = {}
+        self._by_filename: dict[str, Song] = {}
+        for song in songs:
+            self.add(song)
+
+    def add(self, song: Song):
+        """Append a song to the index.
+
+        Args:
+            song(Song): parsed song, as returned by genbook.parse_song
+        """
+        if song.id in self._position:
+            raise ValueError(f"duplicate song ID {song.id}")
+        self._position[song.id] = len(self._songs)
+        self._songs.append(song)
+        song._index = self
+        if song.title:
+            self._by_title.setdefault(song.title.lower(), []).append(song)
+        if song.artist:
+            self._by_artist.setdefault(song.artist.lower(), []).append(song)
+        self._by_filename[song.filename.name] = song
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def __iter__(self) -> Iterator[Song]:
+        return iter(self._songs)
+
+    def __getitem__(self, idx):
+        return self._songs[idx]
+
+    def __contains__(self, songid) -> bool:
+        return songid in self._position
+
+    def by_id(self, songid: str | None) -> Song | None:
+        """Find a song by its ID."""
+        if songid not in self._position:
+            return None
+        return self._songs[self._position[songid]]
+
+    def by_title(self, title: str) -> list[Song]:
+        """Find all songs with the given title."""
+        return self._by_title.get(title.lower(), [])
+
+    def by_artist(self, artist: str) -> list[Song]:
+        """Find all songs by the given artist."""
+        return self._by_artist.get(artist.lower(), [])
+
+    def by_filename(self, filename: str | Path) -> Song | None:
+        """Find a song by its output filename (with or without directories)."""
+        return self._by_filename.get(Path(filename).name)
+
+    def neighbours(self, songid: str) -> tuple[Song | None, Song | None]:
+        """Return the songs either side of the given one, in book order."""
+        pos = self._position[songid]
+        prev = self._songs[pos - 1] if pos > 0 else None
+        nxt = self._songs[pos + 1] if pos + 1 < len(self._songs) else None
+        return prev, nxt
+
+    def link(self, songid: str | None, default: str = "../index.html") -> Path | str:
+        """Generate a relative link from one song page to another.
+
+        Args:
+            songid(str): ID of target song
+            default(str): link to return if there is no such song
+        """
+        song = self.by_id(songid)
+        if song is None:
+            return default
+        return Path("../songs") / song.filename.name
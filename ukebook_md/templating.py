@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Shared Jinja2 environments, with a persistent bytecode cache.
+
+Compiling templates is a noticeable part of the cost of a small build, or of
+rendering a single song. Environments are created once per process for each
+configuration, and compiled templates are kept on disk between runs.
+"""
+
+import json
+from pathlib import Path
+
+import jinja2
+
+from ukebook_md.cache import default_cache_dir, digest
+
+# default location of compiled templates
+TEMPLATE_CACHE = default_cache_dir() / "templates"
+
+_environments: dict[tuple, jinja2.Environment] = {}
+
+
+def bytecode_cache(cachedir: Path, options: dict) -> jinja2.BytecodeCache | None:
+    """Create a bytecode cache for environments with the given options.
+
+    Jinja keys compiled templates on their name and source only, but options
+    such as trim_blocks change the compiled code, so each set of options gets
+    its own subdirectory.
+
+    Returns:
+        BytecodeCache: or None if the cache directory cannot be created
+    """
+    config = digest(jinja2.__version__, json.dumps(options, sort_keys=True))
+    directory = Path(cachedir) / config[:16]
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    return jinja2.FileSystemBytecodeCache(str(directory))
+
+
+def get_environment(
+    *template_dirs: Path, cachedir: Path | None = TEMPLATE_CACHE, **options
+) -> jinja2.Environment:
+    """Return a template environment, creating it on first use.
+
+    Templates are looked up in the given directories, in order, then in the
+    templates shipped with ukebook_md. Environments are shared, so callers
+    must not change anything that affects compilation after creating one
+    (adding filters and globals is fine).
+
+    Args:
+        template_dirs(Path): directories of templates overriding the defaults
+        cachedir(Path): where to keep compiled templates, None to disable
+
+    Kwargs:
+        any other jinja2.Environment options (e.g. trim_blocks)
+    """
+    key = (
+        tuple(str(d) for d in template_dirs),
+        str(cachedir),
+        json.dumps(options, sort_keys=True),
+    )
+    if key not in _environments:
+        loaders: list[jinja2.BaseLoader] = [
+            jinja2.FileSystemLoader(d) for d in template_dirs
+        ]
+        loaders.append(jinja2.PackageLoader("ukebook_md"))
+        _environments[key] = jinja2.Environment(
+            loader=jinja2.ChoiceLoader(loaders),
+            bytecode_cache=(
+                bytecode_cache(cachedir, options) if cachedir is not None else None
+            ),
+            **options,
+        )
+    return _environments[key]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et ci ft=python foldmethod=indent:
+# -*- coding: utf-8 -*-
+"""Word replacement, for family-friendly songbooks."""
+
+import json
+import re
+from functools import cache
+from pathlib import Path
+
+import yaml
+
+from ukebook_md.cache import digest
+
+DEFAULT_WORDLIST = Path(__file__).parent / "swearing.yml"
+
+# a whole word. Matching every word and looking it up means the cost of
+# filtering a song does not depend on the length of the word list
+WORD = re.compile(r"\w+")
+
+
+def match_case(original: str, repl: str) -> str:
+    """Return a replacement in the same case as the text it replaces."""
+    if len(original) > 1 and original.isupper():
+        return repl.upper()
+    if original[0].isupper():
+        return repl[:1].upper() + repl[1:]
+    return repl
+
+
+class WordFilter:
+    """Replace listed words in text, preserving their case.
+
+    Words are replaced whole, and also where they are part of a longer word
+    (shitting, bullshit, motherfucker), unless that longer word is listed
+    itself. Irregular forms (fucked: forgot) and innocent words containing a
+    listed one (shitake: shitake) are given their own entries.
+    """
+
+    def __init__(self, replacements: dict[str, str]):
+        """Create a filter from a mapping of words to their replacements.
+
+        Args:
+            replacements(dict): words (case-insensitive) and replacements
+
+        Raises:
+            ValueError: if a key is not a single word
+        """
+        self.replacements: dict[str, str] = {}
+        for word, repl in replacements.items():
+            if not WORD.fullmatch(str(word)):
+                raise ValueError(f"word list entries must be single words: {word!r}")
+            self.replacements[str(word).lower()] = str(repl)
+        # identifies the word list, for cache keys and build manifests
+        self.digest = digest(json.dumps(self.replacements, sort_keys=True))
+        # listed words inside longer ones, longest first so "fucking" is
+        # preferred to "fuck"
+        self.parts = re.compile(
+            "|".join(
+                re.escape(w) for w in sorted(self.replacements, key=len, reverse=True)
+            )
+            or r"(?!)",
+            re.IGNORECASE,
+        )
+        # filtered words, as songs mostly use the same ones
+        self._filtered: dict[str, str] = {}
+
+    @classmethod
+    def from_file(cls, path: Path = DEFAULT_WORDLIST) -> "WordFilter":
+        """Load a word list from a YAML file of word: replacement pairs."""
+        return cls(yaml.safe_load(Path(path).read_text()) or {})
+
+    def _replace_part(self, match: re.Match) -> str:
+        part = match.group(0)
+        return match_case(part, self.replacements[part.lower()])
+
+    def filter_word(self, word: str) -> str:
+        """Return a single word with any listed words in it replaced."""
+        filtered = self._filtered.get(word)
+        if filtered is None:
+            repl = self.replacements.get(word.lower())
+            if repl is not None:
+                filtered = match_case(word, repl)
+            else:
+                filtered = self.parts.sub(self._replace_part, word)
+            self._filtered[word] = filtered
+        return filtered
+
+    def __call__(self, text: str) -> str:
+        """Return text with every listed word replaced, in a single pass."""
+        return WORD.sub(lambda m: self.filter_word(m.group(0)), text)
+
+
+@cache
+def default_filter() -> WordFilter:
+    """Return the filter for the word list shipped with ukebook-md."""
+    return WordFilter.from_file(DEFAULT_WORDLIST)